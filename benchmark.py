@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Measures the real-time factor, the latency and the memory of the streaming processing over a directory of
+# audio files, in the computationally aware simulation (the audio comes in real time) and in the computationally
+# unaware simulation (--comp_unaware in simulstreaming_whisper.py). The results are printed and saved as JSON.
+# Two saved results can be compared by --compare.
+#
+# The latency of a word is its emission time minus its end timestamp in the audio, as estimated by the most
+# attended frames. In the unaware simulation, the emission time is the end of the processed audio.
+#
+# Examples:
+#   python3 benchmark.py corpus_dir --model_path large-v3.pt --lan cs -l WARNING --output base.json
+#   python3 benchmark.py corpus_dir --model_path large-v3.pt --lan cs -l WARNING --frame_threshold 20 --output ft20.json
+#   python3 benchmark.py --compare base.json ft20.json
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+
+import numpy as np
+import torch
+
+from whisper_streaming.whisper_online_main import processor_args, set_logging, load_audio, load_audio_chunk, asr_factory
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from replay_logdir import StageTimer
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+MODES = ("unaware", "aware")
+
+
+def audio_files(audio_dir):
+    return sorted(os.path.join(audio_dir, f) for f in os.listdir(audio_dir)
+                  if f.lower().endswith((".wav", ".flac", ".mp3", ".ogg")))
+
+
+def run_file(online, audio_path, min_chunk, comp_unaware):
+    '''Processes one file. Returns the emitted words with the emission times and the processing times.'''
+    duration = len(load_audio(audio_path)) / SAMPLING_RATE
+    online.init()
+    words = []  # (emission time, word end, text)
+    times = []
+
+    def process(f, now=None):
+        t = time.perf_counter()
+        o = f()
+        times.append(time.perf_counter() - t)
+        if now is None:
+            now = time.perf_counter() - start
+        for w in (o or {}).get("words", []):
+            words.append((now, w["end"], w["text"]))
+
+    start = time.perf_counter()
+    beg = 0.0
+    if comp_unaware:
+        while beg < duration:
+            end = min(beg + min_chunk, duration)
+            online.insert_audio_chunk(load_audio_chunk(audio_path, beg, end))
+            process(online.process_iter, now=end)
+            beg = end
+        process(online.finish, now=duration)
+    else:
+        while beg < duration:
+            now = time.perf_counter() - start
+            if now < beg + min_chunk:
+                time.sleep(beg + min_chunk - now)
+            end = min(time.perf_counter() - start, duration)
+            online.insert_audio_chunk(load_audio_chunk(audio_path, beg, end))
+            beg = end
+            process(online.process_iter)
+        process(online.finish)
+    return duration, words, times
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "mean": None}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "mean": float(np.mean(values))}
+
+
+def run_mode(online, files, min_chunk, mode, timer):
+    timer.times.clear()
+    per_file = []
+    latencies = []
+    total_duration = total_time = 0.0
+    n_iter = 0
+    for path in files:
+        duration, words, times = run_file(online, path, min_chunk, comp_unaware=(mode == "unaware"))
+        file_latencies = [emitted - end for emitted, end, _ in words]
+        latencies += file_latencies
+        total_duration += duration
+        total_time += sum(times)
+        n_iter += len(times)
+        per_file.append({"file": os.path.basename(path), "duration": duration, "rtf": sum(times) / duration,
+                         "iterations": len(times), "words": len(words), "latency": percentiles(file_latencies)})
+        logger.info(f"{mode} {path}: RTF {sum(times) / duration:.3f}")
+    return {
+        "audio_duration": total_duration,
+        "processing_time": total_time,
+        "rtf": total_time / total_duration if total_duration else None,
+        "iterations": n_iter,
+        "ms_per_iteration": total_time / n_iter * 1000 if n_iter else None,
+        "latency": percentiles(latencies),
+        "stages": timer.summary(),
+        "files": per_file,
+    }
+
+
+def print_mode(mode, r):
+    lat = r["latency"]
+    fmt = lambda x: "-" if x is None else f"{x:.3f}"
+    print(f"{mode}:\tRTF {fmt(r['rtf'])}, {r['iterations']} iterations, {fmt(r['ms_per_iteration'])} ms/iteration, "
+          f"latency p50 {fmt(lat['p50'])} s, p90 {fmt(lat['p90'])} s, p99 {fmt(lat['p99'])} s", flush=True)
+    for stage, s in r["stages"].items():
+        if s["calls"]:
+            print(f"\t{stage}:\t{s['calls']} calls, mean {s['mean']*1000:.1f} ms, total {s['total']:.2f} s", flush=True)
+
+
+def compare(path_a, path_b):
+    a, b = (json.load(open(p)) for p in (path_a, path_b))
+    print(f"A: {path_a}\nB: {path_b}")
+    for mode in MODES:
+        if mode not in a["modes"] or mode not in b["modes"]:
+            continue
+        ra, rb = a["modes"][mode], b["modes"][mode]
+        rows = [("rtf", ra["rtf"], rb["rtf"]), ("ms_per_iteration", ra["ms_per_iteration"], rb["ms_per_iteration"])]
+        rows += [(f"latency {k}", ra["latency"][k], rb["latency"][k]) for k in ("p50", "p90", "p99", "mean")]
+        rows += [(f"stage {s} mean ms", ra["stages"][s]["mean"] * 1000, rb["stages"][s]["mean"] * 1000)
+                 for s in ra["stages"] if s in rb["stages"] and (ra["stages"][s]["calls"] or rb["stages"][s]["calls"])]
+        print(f"{mode}:")
+        for name, x, y in rows:
+            if x is None or y is None:
+                print(f"\t{name}:\tA {x}\tB {y}")
+            else:
+                change = f"{(y - x) / x * 100:+.1f} %" if x else ""
+                print(f"\t{name}:\tA {x:.3f}\tB {y:.3f}\t{change}")
+    print(f"peak RSS MB:\tA {a['peak_rss_mb']:.0f}\tB {b['peak_rss_mb']:.0f}")
+    for k in sorted(set(a["args"]) | set(b["args"])):
+        if a["args"].get(k) != b["args"].get(k):
+            print(f"arg {k}:\tA {a['args'].get(k)}\tB {b['args'].get(k)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('audio_dir', type=str, nargs="?", help="Directory with 16kHz mono audio files.")
+    parser.add_argument('--modes', type=str, nargs="+", default=list(MODES), choices=MODES,
+                        help="unaware: computationally unaware simulation, aware: the audio comes in real time.")
+    parser.add_argument('--output', type=str, default=None, help="Save the results to this JSON file.")
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=("A", "B"),
+                        help="Compare two saved results instead of running the benchmark.")
+    args = parser.parse_args()
+    set_logging(args, logger)
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+    if args.audio_dir is None:
+        parser.error("audio_dir is required unless --compare is used")
+    files = audio_files(args.audio_dir)
+    if not files:
+        logger.error(f"No audio files in {args.audio_dir}.")
+        sys.exit(1)
+
+    asr, online = asr_factory(args, simul_asr_factory)
+    min_chunk = args.vac_chunk_size if args.vac else args.min_chunk_size
+    asr.warmup(load_audio_chunk(files[0], 0, 1))
+    timer = StageTimer(asr.model.model.device)
+    timer.instrument(asr.model)
+
+    results = {"args": {k: v for k, v in vars(args).items() if k not in ("compare", "output")}, "modes": {}}
+    for mode in args.modes:
+        results["modes"][mode] = run_mode(online, files, min_chunk, mode, timer)
+        print_mode(mode, results["modes"][mode])
+
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if torch.cuda.is_available():
+        results["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    print(f"peak RSS:\t{results['peak_rss_mb']:.0f} MB", flush=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Compares the default encoder mode, which pads the audio buffer to 30 seconds, with the --short_context mode,
+# which encodes only the audio buffer and a short margin. Both modes are run on the same audio file in the
+# computationally unaware simulation, with the same loaded model.
+#
+# Example:
+#   python3 compare_encoder_context.py audio.wav --model_path large-v3.pt --lan cs --short_context_margin 50 -l WARNING
+
+import time
+import logging
+import argparse
+
+from whisper_streaming.whisper_online_main import processor_args, set_logging, load_audio, load_audio_chunk
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+
+def word_error_rate(reference, hypothesis):
+    '''Levenshtein distance on words, normalized by the reference length.'''
+    ref = reference.split()
+    hyp = hypothesis.split()
+    if not ref:
+        return float(len(hyp) > 0)
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1] / len(ref)
+
+
+def run(online, audio_path, duration, min_chunk):
+    '''Computationally unaware simulation. Returns the transcript and the processing time of each iteration.'''
+    online.init()
+    texts = []
+    times = []
+    beg = 0
+    while beg < duration:
+        end = min(beg + min_chunk, duration)
+        online.insert_audio_chunk(load_audio_chunk(audio_path, beg, end))
+        if end >= duration:
+            o = online.finish()
+        else:
+            t = time.perf_counter()
+            o = online.process_iter()
+            times.append(time.perf_counter() - t)
+        if o:
+            texts.append(o['text'])
+        beg = end
+    return "".join(texts).strip(), times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav.")
+    args = parser.parse_args()
+    set_logging(args, logger)
+
+    if args.vac:
+        logger.warning("--vac is ignored, the comparison runs without VAD.")
+    duration = len(load_audio(args.audio_path)) / SAMPLING_RATE
+
+    asr, online = simul_asr_factory(args)
+    asr.warmup(load_audio_chunk(args.audio_path, 0, 1))
+    cfg = asr.model.cfg
+
+    results = {}
+    for short_context in (False, True):
+        cfg.short_context = short_context
+        name = "short" if short_context else "padded"
+        text, times = run(online, args.audio_path, duration, args.min_chunk_size)
+        results[name] = (text, times)
+        print(f"{name} transcript:\t{text}", flush=True)
+
+    padded_text, padded_times = results["padded"]
+    short_text, short_times = results["short"]
+    padded_mean = sum(padded_times) / max(len(padded_times), 1)
+    short_mean = sum(short_times) / max(len(short_times), 1)
+    print(f"audio duration:\t{duration:.2f} s", flush=True)
+    print(f"short context margin:\t{cfg.short_context_margin} frames", flush=True)
+    print(f"padded:\t{len(padded_times)} iterations, mean {padded_mean*1000:.1f} ms, total {sum(padded_times):.2f} s", flush=True)
+    print(f"short:\t{len(short_times)} iterations, mean {short_mean*1000:.1f} ms, total {sum(short_times):.2f} s", flush=True)
+    if short_mean > 0:
+        print(f"speedup:\t{padded_mean/short_mean:.2f}x", flush=True)
+    print(f"WER of short against padded:\t{word_error_rate(padded_text, short_text)*100:.2f} %", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Replays the infer() iterations that were recorded with --logdir, offline, with the same or another model and
+# options. The audio of every iteration is inserted into a new session in the same segmentation as it was
+# recorded, so the audio buffers are the same. It reports the time of the processing stages and the iterations
+# whose hypothesis differs from the recorded one.
+#
+# Example:
+#   python3 replay_logdir.py logdir --model_path large-v3.pt --lan cs -l WARNING
+
+import os
+import json
+import time
+import logging
+import argparse
+from collections import defaultdict
+
+import torch
+
+from whisper_streaming.whisper_online_main import processor_args, set_logging
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from simul_whisper.logdir_recorder import read_segment
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    '''Measures the time of the calls of the model methods that implement the processing stages.'''
+
+    def __init__(self, device):
+        self.device = device
+        self.times = defaultdict(list)
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def wrap(self, obj, method, stage):
+        f = getattr(obj, method)
+        def timed(*a, **kw):
+            self._sync()
+            t = time.perf_counter()
+            r = f(*a, **kw)
+            self._sync()
+            self.times[stage].append(time.perf_counter() - t)
+            return r
+        setattr(obj, method, timed)
+
+    def instrument(self, model):
+        '''Wraps the stages of PaddedAlignAttWhisper. The decoder steps and the alignment are measured in the
+        sequential decoding, not in the decode engine of --decode_batch_size.'''
+        self.wrap(model, "infer", "total")
+        self.wrap(model, "_mel", "mel")
+        self.wrap(model, "encode", "encoder")
+        self.wrap(model, "lang_id", "lang_id")
+        self.wrap(model, "logits", "decoder step")
+        self.wrap(model.alignment, "most_attended_frames", "alignment")
+
+    def summary(self):
+        stages = ["total", "mel", "encoder", "lang_id", "decoder step", "alignment"]
+        return {s: {"calls": len(self.times[s]), "total": sum(self.times[s]),
+                    "mean": sum(self.times[s]) / len(self.times[s]) if self.times[s] else 0.0}
+                for s in stages}
+
+
+def recorded_sessions(logdir):
+    '''Returns the recorded sessions: session id -> list of (segment dir, audio, iteration records) in order.'''
+    sessions = defaultdict(list)
+    for name in sorted(os.listdir(logdir)):
+        path = os.path.join(logdir, name)
+        if not name.startswith("seg_") or not os.path.isdir(path):
+            continue
+        audio, records = read_segment(path)
+        if records:
+            sessions[records[0].get("session", 0)].append((path, audio, records))
+    return dict(sorted(sessions.items()))
+
+
+def new_segments(audio, record, prev_end):
+    '''Returns the audio that was inserted before the iteration, split as it was inserted.'''
+    start, end = record["audio_start"], record["audio_end"]
+    n_new = end - prev_end if prev_end is not None and start <= prev_end else end - start
+    segments = []
+    pos = end
+    for length in reversed(record["segments"]):
+        if end - pos >= n_new:
+            break
+        segments.insert(0, audio[pos - length:pos])
+        pos -= length
+    if end - pos != n_new:
+        # not aligned with the recorded segmentation, e.g. a dropped record. Insert the new audio at once.
+        segments = [audio[end - n_new:end]] if n_new > 0 else []
+    return segments
+
+
+def replay(model, logdir):
+    '''Replays the recorded sessions with the model. Returns the list of the iteration results.'''
+    results = []
+    for session_id, segment_dirs in recorded_sessions(logdir).items():
+        state = model.new_session()
+        for path, audio, records in segment_dirs:
+            model.refresh_segment(complete=True, state=state)
+            prev_end = None
+            for record in records:
+                segments = new_segments(audio, record, prev_end)
+                if not segments:
+                    model.insert_audio(None, state=state)
+                for s in segments:
+                    model.insert_audio(torch.from_numpy(s), state=state)
+                prev_end = record["audio_end"]
+                tokens, _ = model.infer(is_last=record.get("is_last", False), state=state)
+                results.append({
+                    "session": session_id,
+                    "segment": os.path.basename(path),
+                    "iteration": record["iteration"],
+                    "recorded": record["hypothesis"],
+                    "replayed": state.tokenizer.decode(tokens),
+                    "same": list(tokens) == record["tokens"],
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('recorded_logdir', type=str, help="The --logdir of the recorded processing.")
+    parser.add_argument('--report', type=str, default=None, help="Save the timings and the iteration results to this JSON file.")
+    args = parser.parse_args()
+    set_logging(args, logger)
+    args.logdir = None  # the replay is not recorded
+
+    asr, _ = simul_asr_factory(args)
+    model = asr.model
+    timer = StageTimer(model.model.device)
+    timer.instrument(model)
+
+    results = replay(model, args.recorded_logdir)
+
+    for r in results:
+        if not r["same"]:
+            print(f"DIFF\t{r['segment']}\titer {r['iteration']}\trecorded: {r['recorded']!r}\treplayed: {r['replayed']!r}", flush=True)
+    summary = timer.summary()
+    for stage, s in summary.items():
+        print(f"{stage}:\t{s['calls']} calls, mean {s['mean']*1000:.1f} ms, total {s['total']:.2f} s", flush=True)
+    n_same = sum(r["same"] for r in results)
+    print(f"iterations:\t{len(results)}, same hypothesis: {n_same}, different: {len(results) - n_same}", flush=True)
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump({"timings": summary, "iterations": results}, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
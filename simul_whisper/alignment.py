@@ -0,0 +1,56 @@
+import torch
+import torch.nn.functional as F
+
+from .whisper.timing import median_filter
+
+
+class AlignmentTracker:
+    '''Finds the most attended audio frame of the last decoded token, from the cross-attention of the alignment heads.
+
+    The attention of every alignment head is normalized over all the tokens of the generation (the prompt included),
+    median filtered along the frames, averaged over the heads, and the argmax of the last token is taken. Only the
+    last token row is needed, so instead of keeping the attention of all the tokens, the tracker keeps per-head
+    running sums of the attention and of its square over the tokens. Every decoder forward pass adds only the rows
+    of its new tokens, so the cost of a step does not grow with the number of decoded tokens.
+
+    The batch rows are accumulated by their index, also in beam search after the beams are reordered, as the
+    attention matrices were concatenated by the original implementation.
+    '''
+
+    def __init__(self, align_source: dict, num_align_heads: int, filter_width: int = 7):
+        '''align_source: decoder layer rank -> list of (alignment head rank, head id in the layer)'''
+        self.align_source = align_source
+        self.num_align_heads = num_align_heads
+        self.filter_width = filter_width
+        self.reset()
+
+    def reset(self):
+        self.n_tokens = [0] * self.num_align_heads
+        self.sum = [None] * self.num_align_heads
+        self.sum_sq = [None] * self.num_align_heads
+        self.last = [None] * self.num_align_heads
+
+    def update(self, layer_rank: int, qk: torch.Tensor):
+        '''qk: the cross-attention logits of a decoder layer, shape = (batch, n_head, n_tokens, n_frames)'''
+        for align_head_rank, head_id in self.align_source.get(layer_rank, []):
+            a = F.softmax(qk[:, head_id], dim=-1)
+            a64 = a.double()
+            s, s2 = a64.sum(dim=1), (a64 * a64).sum(dim=1)
+            if self.sum[align_head_rank] is None:
+                self.sum[align_head_rank], self.sum_sq[align_head_rank] = s, s2
+            else:
+                self.sum[align_head_rank] += s
+                self.sum_sq[align_head_rank] += s2
+            self.n_tokens[align_head_rank] += a.shape[1]
+            self.last[align_head_rank] = a[:, -1]
+
+    def most_attended_frames(self, content_mel_len: int) -> torch.Tensor:
+        '''Returns the most attended frame of the last token for each batch item, shape = (batch,)'''
+        last = torch.stack(self.last, dim=1)  # batch, align heads, frames
+        n = torch.tensor(self.n_tokens, dtype=torch.float64, device=last.device)[None, :, None]
+        mean = torch.stack(self.sum, dim=1) / n
+        var = (torch.stack(self.sum_sq, dim=1) / n - mean * mean).clamp(min=0)
+        normalized = ((last.double() - mean) / var.sqrt()).to(last.dtype)
+        filtered = median_filter(normalized.unsqueeze(2), self.filter_width).squeeze(2)
+        attn = filtered.mean(dim=1)[:, :content_mel_len]
+        return torch.argmax(attn, dim=-1)
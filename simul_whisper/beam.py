@@ -10,8 +10,7 @@ class BeamPyTorchInference(PyTorchInference):
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
-            for module_cache_id in self._kv_modules():
-                self.kv_cache[module_cache_id] = self.kv_cache[module_cache_id][source_indices].detach()
+            self.kv_cache.rearrange(self._kv_modules(), source_indices)
     from torch import Tensor
-    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
\ No newline at end of file
+    def logits(self, tokens: Tensor, audio_features: Tensor, logit_positions=None) -> Tensor:
+        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache, logit_positions=logit_positions)
\ No newline at end of file
@@ -24,6 +24,8 @@ class SimulWhisperConfig:
     logprob_threshold: float = field(default=-1.0, metadata={"help": "If avg logprob is below this, likely hallucination. Very negative to disable."})
 
     logdir: str = field(default="logdir", metadata={"help": "Directory to save audio segments and tokens for debugging purposes."})
+    logdir_queue_size: int = field(default=256, metadata={"help": "Max number of iterations waiting to be written to the logdir. More are dropped."})
+    telemetry: Literal["minimal","standard","full"] = field(default="standard", metadata={"help": "What the generation info of infer() keeps. minimal: only the most attended frames for the word timestamps. standard: also the tokens and scores of every step. full: also the logits."})
 
 @dataclass
 class AlignAttConfig(SimulWhisperConfig):
@@ -33,6 +35,17 @@ class AlignAttConfig(SimulWhisperConfig):
     frame_threshold: int = 4
     rewind_threshold: int = 200 # in frames. Max value is 1500. Higher value turns rewinds off.
     audio_max_len: float = 5.0
+    short_context: bool = field(default=False, metadata={"help": "Encode only the real audio frames plus a margin instead of the audio padded to 30 seconds."})
+    short_context_margin: int = field(default=50, metadata={"help": "Number of zero-padding encoder frames appended to the audio in the short context mode. One frame is 0.02 seconds."})
+    decoder_frames_margin: int = field(default=None, metadata={"help": "If set, the decoder cross-attends only to the encoder frames of the audio and this number of following frames. None: all frames."})
+    sdpa: bool = field(default=True, metadata={"help": "Use the fused scaled_dot_product_attention for all attention except the alignment heads."})
+    encoder_batch_size: int = field(default=1, metadata={"help": "Max number of concurrent sessions whose encoder inputs are encoded in one batch. 1: no batching."})
+    encoder_batch_wait: float = field(default=0.01, metadata={"help": "Max time in seconds to wait for more encoder inputs to the batch."})
+    decode_batch_size: int = field(default=1, metadata={"help": "Max number of concurrent sessions whose decoding steps run in one batch. 1: no batching."})
+    language_candidates: str = field(default=None, metadata={"help": "Comma-separated language codes that the language identification chooses from, e.g. 'vi,en'. None: all languages."})
+    language_confirm_utterances: int = field(default=2, metadata={"help": "Min number of utterances to confirm the detected language of a session."})
+    language_confirm_prob: float = field(default=0.8, metadata={"help": "Min mean probability of the detected language to confirm it."})
+    language_recheck_interval: int = field(default=20, metadata={"help": "Detect the confirmed language again after this number of utterances. 0: never."})
     cif_ckpt_path: str = ""
     never_fire: bool = False
     max_tokens_per_segment: int = field(default=100, metadata={"help": "Max tokens per audio segment. Prevents runaway generation."})
\ No newline at end of file
@@ -0,0 +1,294 @@
+import atexit
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .whisper.decoding import BeamSearchDecoder
+from .whisper.model import SDPA_AVAILABLE, scaled_dot_product_attention
+from .alignment import AlignmentTracker
+from .session import DecodingJob
+
+logger = logging.getLogger(__name__)
+
+
+class _JobInference:
+    '''The inference object of the BeamSearchDecoder of one job. It reorders the job's rows of the engine cache.'''
+
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+
+    def rearrange_kv_cache(self, source_indices):
+        if source_indices != list(range(len(source_indices))):
+            self.engine.rearrange_rows(self.job, source_indices)
+
+
+class DecodeEngine:
+    '''Continuous batching of the AlignAtt decoding loops of many sessions of one PaddedAlignAttWhisper.
+
+    The sessions submit their jobs from their threads and wait for the results. A worker thread runs the first
+    decoder forward pass of every new job separately, because the jobs have prefixes of different lengths. Then it
+    advances all active jobs by one token in one batched decoder forward pass per step. Every job leaves the batch
+    on its own stop condition, and new jobs join it in the next step.
+
+    The self-attention keys and values of all rows are in preallocated buffers of shape (rows, n_text_ctx, n_state).
+    A job occupies beam_size rows. The rows have different lengths, so the batched self-attention masks the positions
+    after the row's length, and the cross-attention masks the frames after the job's encoder features.
+    '''
+
+    def __init__(self, aligner, max_batch_size: int):
+        '''aligner: PaddedAlignAttWhisper. max_batch_size: max number of concurrently decoded jobs.'''
+        self.aligner = aligner
+        self.decoder = aligner.model.decoder
+        self.max_batch_size = max_batch_size
+        self.beam_size = aligner.cfg.beam_size
+        self.n_ctx = aligner.model.dims.n_text_ctx
+        self.n_head = self.decoder.blocks[0].attn.n_head
+
+        n_rows = max_batch_size * self.beam_size
+        n_state = aligner.model.dims.n_text_state
+        weight = self.decoder.token_embedding.weight
+        self.keys = [weight.new_zeros((n_rows, self.n_ctx, n_state)) for _ in self.decoder.blocks]
+        self.values = [weight.new_zeros((n_rows, self.n_ctx, n_state)) for _ in self.decoder.blocks]
+        self.free_rows = list(range(n_rows))
+
+        self.requests = queue.Queue()
+        self.worker = None
+        self.worker_lock = threading.Lock()
+        self.closed = False
+        self.stopping = False  # the worker received the stop sentinel
+        atexit.register(self.close)
+
+    def decode(self, job: DecodingJob):
+        '''Blocks until the job is decoded. Returns the new hypothesis and the generation info, as infer().'''
+        with self.worker_lock:
+            if self.closed:
+                raise RuntimeError("The decode engine is closed.")
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True, name="DecodeEngine")
+                self.worker.start()
+        future = Future()
+        self.requests.put((job, future))
+        return future.result()
+
+    def close(self):
+        '''Stops the worker after the jobs that are being decoded. The engine can't be used after that.'''
+        with self.worker_lock:
+            self.closed = True
+            worker = self.worker
+        if worker is not None and worker.is_alive():
+            self.requests.put(None)
+            worker.join()
+
+    ### the cache rows
+
+    def rearrange_rows(self, job, source_indices):
+        rows = job.rows
+        source = rows[source_indices]
+        for k, v in zip(self.keys, self.values):
+            k[rows] = k[source]
+            v[rows] = v[source]
+
+    def _admit(self, job: DecodingJob):
+        '''The part of the job until the end of the first decoder forward pass and the first step.'''
+        aligner = self.aligner
+        job.alignment = AlignmentTracker(aligner.returned_heads, aligner.num_align_heads)
+        if aligner.decoder_type == "beam":
+            job.token_decoder = BeamSearchDecoder(inference=_JobInference(self, job), eot=aligner.tokenizer.eot,
+                                                  beam_size=self.beam_size)
+        else:
+            job.token_decoder = aligner.token_decoder
+        aligner._start_job(job)
+        if job.done:
+            return
+
+        # the first forward pass with the whole prefix, through the model's hooks and KV cache
+        tokens, logit_positions = aligner._job_input(job)
+        kv_cache = aligner.kv_cache
+        shared_alignment, aligner.alignment = aligner.alignment, job.alignment
+        try:
+            logits = self.decoder(tokens, job.encoder_feature, kv_cache=kv_cache, logit_positions=logit_positions)
+        finally:
+            aligner.alignment = shared_alignment
+
+        n_rows = tokens.shape[0]
+        job.rows = torch.tensor(self.free_rows[:n_rows], device=tokens.device)
+        del self.free_rows[:n_rows]
+        job.length = tokens.shape[1]
+        job.cross_keys, job.cross_values = [], []
+        for i, block in enumerate(self.decoder.blocks):
+            self.keys[i][job.rows, :job.length] = kv_cache[block.attn.key.cache_id]
+            self.values[i][job.rows, :job.length] = kv_cache[block.attn.value.cache_id]
+            job.cross_keys.append(kv_cache[block.cross_attn.key.cache_id])
+            job.cross_values.append(kv_cache[block.cross_attn.value.cache_id])
+        kv_cache.reset()
+
+        aligner._job_step(job, logits)
+
+    def _release(self, job: DecodingJob):
+        if job.rows is not None:
+            self.free_rows.extend(job.rows.tolist())
+            job.rows = None
+
+    ### the batched decoder forward pass
+
+    def _attention(self, q, k, v, mask):
+        '''q: (rows, 1, n_state), k, v: (rows, n_keys, n_state), mask: (rows, 1, 1, n_keys) bool, True = attend'''
+        n_rows = q.shape[0]
+        q = q.view(n_rows, -1, self.n_head, q.shape[-1] // self.n_head).permute(0, 2, 1, 3)
+        k = k.view(n_rows, -1, self.n_head, k.shape[-1] // self.n_head).permute(0, 2, 1, 3)
+        v = v.view(n_rows, -1, self.n_head, v.shape[-1] // self.n_head).permute(0, 2, 1, 3)
+        if SDPA_AVAILABLE:
+            a = scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        else:
+            scale = q.shape[-1] ** -0.5
+            qk = (q @ k.transpose(-1, -2)).float() * scale
+            if mask is not None:
+                qk = qk.masked_fill(~mask, -np.inf)
+            a = F.softmax(qk, dim=-1).to(q.dtype) @ v
+        return a.permute(0, 2, 1, 3).flatten(start_dim=2)
+
+    def _alignment_logits(self, cross_attn, q, k):
+        '''The cross-attention logits of the alignment heads, shape = (rows, n_align_heads_in_layer, 1, n_frames)'''
+        n_rows = q.shape[0]
+        scale = (q.shape[-1] // self.n_head) ** -0.25
+        q = q.view(n_rows, -1, self.n_head, q.shape[-1] // self.n_head).permute(0, 2, 1, 3)[:, cross_attn.qk_heads]
+        k = k.view(n_rows, -1, self.n_head, k.shape[-1] // self.n_head).permute(0, 2, 1, 3)[:, cross_attn.qk_heads]
+        return ((q * scale) @ (k * scale).transpose(-1, -2)).float()
+
+    def _cross_kv(self, jobs):
+        '''Stacks the cross-attention keys and values of the jobs, padded to the longest encoder features.'''
+        n_frames = [job.cross_keys[0].shape[1] for job in jobs]
+        max_frames = max(n_frames)
+        def stack(tensors):
+            # the encoder features of a job are shared by its beams
+            return torch.cat([F.pad(x, (0, 0, 0, max_frames - n)).expand(job.rows.shape[0], -1, -1)
+                              for x, job, n in zip(tensors, jobs, n_frames)])
+        keys, values = [], []
+        for i in range(len(self.decoder.blocks)):
+            keys.append(stack([job.cross_keys[i] for job in jobs]))
+            values.append(stack([job.cross_values[i] for job in jobs]))
+        if all(n == max_frames for n in n_frames):
+            mask = None
+        else:
+            frames = torch.arange(max_frames, device=keys[0].device)
+            mask = torch.cat([(frames < n).expand(job.rows.shape[0], max_frames) for job, n in zip(jobs, n_frames)])
+            mask = mask[:, None, None, :]
+        return keys, values, mask, n_frames
+
+    def _step(self, jobs, cross):
+        '''One batched decoder forward pass with the last token of every row of the jobs. Returns the logits of
+        the jobs, each of shape (rows of the job, 1, n_vocab).'''
+        cross_keys, cross_values, cross_mask, n_frames = cross
+        rows = torch.cat([job.rows for job in jobs])
+        tokens = torch.cat([job.current_tokens[:, -1:] for job in jobs])
+        offsets = torch.cat([torch.full_like(job.rows, job.length) for job in jobs])
+        n_keys = max(job.length for job in jobs) + 1
+        self_mask = (torch.arange(n_keys, device=rows.device)[None, :] <= offsets[:, None])[:, None, None, :]
+        job_rows = np.cumsum([0] + [job.rows.shape[0] for job in jobs])
+
+        decoder = self.decoder
+        x = decoder.token_embedding(tokens) + decoder.positional_embedding[offsets].unsqueeze(1)
+        for i, block in enumerate(decoder.blocks):
+            h = block.attn_ln(x)
+            q = block.attn.query(h)
+            # forward() instead of __call__, because the hooks of the aligner write into its KV cache
+            self.keys[i][rows, offsets] = block.attn.key.forward(h)[:, 0]
+            self.values[i][rows, offsets] = block.attn.value.forward(h)[:, 0]
+            k = self.keys[i][rows, :n_keys]
+            v = self.values[i][rows, :n_keys]
+            x = x + block.attn.out(self._attention(q, k, v, self_mask))
+
+            h = block.cross_attn_ln(x)
+            q = block.cross_attn.query(h)
+            x = x + block.cross_attn.out(self._attention(q, cross_keys[i], cross_values[i], cross_mask))
+            if block.cross_attn.qk_heads is not None:
+                qk = self._alignment_logits(block.cross_attn, q, cross_keys[i])
+                for j, job in enumerate(jobs):
+                    job.alignment.update(i, qk[job_rows[j]:job_rows[j+1], :, :, :n_frames[j]])
+
+            x = x + block.mlp(block.mlp_ln(x))
+
+        x = decoder.ln(x)
+        logits = x @ torch.transpose(decoder.token_embedding.weight, 0, 1)
+        for job in jobs:
+            job.length += 1
+        return [logits[job_rows[j]:job_rows[j+1]] for j in range(len(jobs))]
+
+    ### the worker
+
+    def _finish(self, job, future):
+        self._release(job)
+        try:
+            new_hypothesis, generation = self.aligner._finish_job(job)
+            self.aligner.logdir_save(job.state, job.input_segments, new_hypothesis, generation, job.is_last)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result((new_hypothesis, generation))
+
+    def _new_jobs(self, block):
+        new = []
+        while len(new) < len(self.free_rows) // self.beam_size and not self.stopping:
+            try:
+                request = self.requests.get(block=block and not new)
+            except queue.Empty:
+                break
+            if request is None:
+                self.stopping = True
+            else:
+                new.append(request)
+        return new
+
+    @torch.no_grad()
+    def _run(self):
+        active = []  # (job, future)
+        cross = None
+        while True:
+            if self.stopping and not active:
+                return
+            new = self._new_jobs(block=not active)
+            with self.aligner.lock:
+                for job, future in new:
+                    try:
+                        self._admit(job)
+                    except Exception as e:
+                        self._release(job)
+                        self.aligner.kv_cache.reset()
+                        future.set_exception(e)
+                        continue
+                    if job.done:
+                        self._finish(job, future)
+                    else:
+                        active.append((job, future))
+                        cross = None
+                if not active:
+                    continue
+
+                jobs = [job for job, _ in active]
+                if cross is None:
+                    cross = self._cross_kv(jobs)
+                try:
+                    logits = self._step(jobs, cross)
+                    for job, job_logits in zip(jobs, logits):
+                        self.aligner._job_step(job, job_logits)
+                except Exception as e:
+                    for job, future in active:
+                        self._release(job)
+                        future.set_exception(e)
+                    active, cross = [], None
+                    continue
+
+                still_active = []
+                for job, future in active:
+                    if job.done:
+                        self._finish(job, future)
+                        cross = None
+                    else:
+                        still_active.append((job, future))
+                active = still_active
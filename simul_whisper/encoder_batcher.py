@@ -0,0 +1,69 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class EncoderBatcher:
+    '''Runs the audio encoder for many concurrent streams in batches.
+
+    The streams call encode() from their own threads. A worker thread takes the first waiting input, collects more
+    inputs until max_batch_size or until max_wait seconds pass, and runs one batched encoder forward pass for the
+    inputs of the same shape. The features are returned to the waiting callers.
+    '''
+
+    def __init__(self, encoder: torch.nn.Module, max_batch_size: int, max_wait: float):
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = None
+        self.worker_lock = threading.Lock()
+
+    def encode(self, mel: torch.Tensor) -> torch.Tensor:
+        '''mel: shape = (1, n_mels, n_frames). Blocks until the batch with this input is encoded.'''
+        with self.worker_lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True, name="EncoderBatcher")
+                self.worker.start()
+        future = Future()
+        self.requests.put((mel, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    @torch.no_grad()
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # the inputs of different lengths, e.g. in the short context mode, are encoded separately
+            groups = {}
+            for mel, future in batch:
+                groups.setdefault(tuple(mel.shape[1:]), []).append((mel, future))
+            for group in groups.values():
+                mels, futures = zip(*group)
+                try:
+                    features = self.encoder(torch.cat(mels, dim=0))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                logger.debug(f"Encoded a batch of {len(futures)} inputs of shape {tuple(mels[0].shape)}")
+                for i, future in enumerate(futures):
+                    future.set_result(features[i:i+1])
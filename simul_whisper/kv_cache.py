@@ -0,0 +1,62 @@
+import torch
+
+
+class StaticKVCache(dict):
+    '''Key-value cache of the decoder with preallocated buffers for the self-attention.
+
+    It maps the cache_id of the key and value projection modules to the cached tensors, as the plain dict that
+    MultiHeadAttention and TextDecoder expect. The self-attention keys and values are written in place into
+    buffers of shape (batch, n_ctx, n_state) that are allocated once and reused for the next generations,
+    instead of growing the cache by torch.cat on every decoded token. The dict values are views of the buffers.
+    The cross-attention keys and values are computed once per generation and stored as they are.
+    '''
+
+    def __init__(self, n_ctx: int):
+        super().__init__()
+        self.n_ctx = n_ctx
+        self.buffers = {}  # cache_id -> (batch, n_ctx, n_state) tensor
+        self.scratch = {}  # cache_id -> a buffer of the same shape, target of beam reordering
+
+    def reset(self):
+        '''Empties the cache for the next generation, but keeps the buffers.'''
+        self.clear()
+
+    @property
+    def offset(self):
+        '''The number of tokens in the self-attention cache.'''
+        return max((self[c].shape[1] for c in self.buffers if c in self), default=0)
+
+    def _buffer(self, cache_id, x: torch.Tensor):
+        buf = self.buffers.get(cache_id)
+        if buf is None or buf.shape[0] < x.shape[0] or buf.shape[2] != x.shape[2] \
+                or buf.dtype != x.dtype or buf.device != x.device:
+            buf = x.new_empty((x.shape[0], self.n_ctx, x.shape[2]))
+            if cache_id in self:
+                cached = self[cache_id]
+                buf[:cached.shape[0], :cached.shape[1]] = cached
+            self.buffers[cache_id] = buf
+            self.scratch[cache_id] = torch.empty_like(buf)
+        return buf
+
+    def append(self, cache_id, x: torch.Tensor) -> torch.Tensor:
+        '''Writes the self-attention keys or values of the new tokens, x of shape (batch, n_tokens, n_state),
+        after the cached ones. Returns the keys or values of all the tokens.'''
+        n = self[cache_id].shape[1] if cache_id in self else 0
+        if n + x.shape[1] > self.n_ctx:
+            raise ValueError(f"The KV cache of {cache_id} is full: {n} + {x.shape[1]} > {self.n_ctx} tokens.")
+        buf = self._buffer(cache_id, x)
+        batch = x.shape[0]
+        buf[:batch, n:n + x.shape[1]] = x
+        self[cache_id] = buf[:batch, :n + x.shape[1]]
+        return self[cache_id]
+
+    def rearrange(self, cache_ids, source_indices):
+        '''Reorders the batch items of the self-attention caches for the updated beams.'''
+        for cache_id in cache_ids:
+            cached = self[cache_id]
+            batch, n = len(source_indices), cached.shape[1]
+            index = torch.tensor(source_indices, device=cached.device)
+            buf, scratch = self.buffers[cache_id], self.scratch[cache_id]
+            torch.index_select(cached, 0, index, out=scratch[:batch, :n])
+            self.buffers[cache_id], self.scratch[cache_id] = scratch, buf
+            self[cache_id] = scratch[:batch, :n]
@@ -0,0 +1,73 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LanguageTracker:
+    '''The language of one session with --lan auto, detected over the utterances instead of in every utterance.
+
+    The language is detected in the first utterances, until the mean probability of the most probable language
+    over at least confirm_utterances detections reaches confirm_prob. Then the language is confirmed and the next
+    utterances reuse it without the language identification and a new tokenizer. It is checked again after every
+    recheck_interval utterances, and in the next utterance after a generation whose output was discarded by the
+    compression ratio or logprob check, or that was taken for no speech, because a wrong language looks like that.
+    If the check finds another language with the confirm_prob, the confirmation starts again.
+
+    An utterance is counted when its segment is refreshed after a generation. With VAC, the segment is refreshed
+    both at the start and at the end of every utterance, and only the end follows a generation.
+    '''
+
+    def __init__(self, confirm_utterances: int = 2, confirm_prob: float = 0.8, recheck_interval: int = 20):
+        '''recheck_interval: in utterances, 0 for no periodic check'''
+        self.confirm_utterances = confirm_utterances
+        self.confirm_prob = confirm_prob
+        self.recheck_interval = recheck_interval
+        self.language = None  # the confirmed language
+        self.prob_sums = {}  # language -> sum of the probabilities of the detections that are not confirmed yet
+        self.n_detections = 0
+        self.utterances_since_check = 0
+        self.suspicious = False
+        self.generated = False  # a generation was reported since the last next_utterance()
+
+    def needs_detection(self) -> bool:
+        if self.language is None or self.suspicious:
+            return True
+        return self.recheck_interval > 0 and self.utterances_since_check >= self.recheck_interval
+
+    def next_utterance(self):
+        '''Called when the segment is refreshed. Counts the utterance if it was generated.'''
+        if self.generated:
+            self.utterances_since_check += 1
+            self.generated = False
+
+    def observe(self, language_probs: dict) -> str:
+        '''Takes the language probabilities of a detection and returns the language for the current utterance.'''
+        top_lan, p = max(language_probs.items(), key=lambda x: x[1])
+        self.utterances_since_check = 0
+        self.suspicious = False
+        if self.language is not None:
+            if top_lan == self.language or p < self.confirm_prob:
+                logger.debug(f"Language {self.language} kept, detected {top_lan} with p={p:.4f}")
+                return self.language
+            logger.info(f"Language changed from {self.language} to {top_lan} with p={p:.4f}")
+            self.language = None
+            self.prob_sums, self.n_detections = {}, 0
+
+        for lan, lp in language_probs.items():
+            self.prob_sums[lan] = self.prob_sums.get(lan, 0.0) + lp
+        self.n_detections += 1
+        mean_lan, mean_sum = max(self.prob_sums.items(), key=lambda x: x[1])
+        if self.n_detections >= self.confirm_utterances and mean_sum / self.n_detections >= self.confirm_prob:
+            logger.info(f"Language {mean_lan} confirmed after {self.n_detections} detections, "
+                        f"mean p={mean_sum / self.n_detections:.4f}")
+            self.language = mean_lan
+            self.prob_sums, self.n_detections = {}, 0
+            return self.language
+        return top_lan
+
+    def report(self, generation: dict):
+        '''Counts the generation in the current utterance, and marks the language for a check in the next utterance
+        if the output of the generation was discarded or taken for no speech.'''
+        self.generated = True
+        if generation.get("hallucination_detected") in ("compression_ratio", "logprob") or generation.get("no_speech"):
+            self.suspicious = True
@@ -0,0 +1,115 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# the files in every segment directory of the logdir
+AUDIO_FILE = "audio.pcm"  # 16 kHz mono 16-bit little-endian PCM, every sample of the segment once
+INDEX_FILE = "iterations.jsonl"  # one JSON line per infer() iteration
+
+SAMPLING_RATE = 16000
+
+
+def read_segment(segment_dir):
+    '''Returns the audio of a segment directory as float32 numpy array, and the list of its iteration records.
+    The audio buffer of an iteration is audio[record["audio_start"]:record["audio_end"]].'''
+    audio = np.fromfile(os.path.join(segment_dir, AUDIO_FILE), dtype="<i2").astype(np.float32) / 32768
+    with open(os.path.join(segment_dir, INDEX_FILE)) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return audio, records
+
+
+class LogdirRecorder:
+    '''Writes the audio and the results of the infer() iterations to the logdir in a background thread.
+
+    The audio buffers of consecutive iterations overlap, so every sample is written only once, appended to the
+    audio file of the segment directory. Every iteration appends a JSON line with the position of its audio buffer
+    in the audio file, the prompt, the hypothesis tokens and text, and the most attended frames of the steps.
+
+    record() only puts the data to a bounded queue. If the writer does not keep up, the iteration records are
+    dropped and counted, but the audio is not lost unless it leaves the buffer before the next written iteration.
+    '''
+
+    def __init__(self, logdir: str, max_queue: int = 256):
+        self.logdir = logdir
+        os.makedirs(logdir, exist_ok=True)
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.segments = {}  # segment dir -> (samples written to its audio file, end of the written audio in the stream)
+        self.dropped = 0
+        self.worker = threading.Thread(target=self._run, daemon=True, name="LogdirRecorder")
+        self.worker.start()
+        atexit.register(self.close)
+
+    def record(self, segment: int, iteration: int, tokenizer, audio: torch.Tensor, audio_end: int,
+               new_hypothesis, generation, **fields):
+        '''audio: the audio buffer of the iteration, audio_end: the number of samples of the stream at its end,
+        fields: more JSON serializable values for the record'''
+        request = (segment, iteration, time.time(), tokenizer, audio, audio_end, list(new_hypothesis), generation, fields)
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"The logdir recorder does not keep up, {self.dropped} iterations dropped.")
+
+    def close(self):
+        '''Writes the waiting records. The recorder can't be used after that.'''
+        if self.worker.is_alive():
+            self.requests.put(None)
+            self.worker.join()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            try:
+                self._write(*request)
+            except Exception:
+                logger.exception("Writing to the logdir failed.")
+
+    def _write(self, segment, iteration, timestamp, tokenizer, audio, audio_end, new_hypothesis, generation, fields):
+        dir = os.path.join(self.logdir, f"seg_{segment:05d}")
+        if dir not in self.segments:
+            os.makedirs(dir, exist_ok=True)
+            self.segments[dir] = (0, None)
+        written, written_end = self.segments[dir]
+
+        length = audio.shape[0]
+        if written_end is None or audio_end - written_end > length:
+            new = audio  # the first iteration of the segment, or the audio since the last written one is lost
+        else:
+            new = audio[length - (audio_end - written_end):]
+        if new.shape[0] > 0:
+            # the inverse of read_segment, so that audio from 16-bit PCM round-trips exactly
+            samples = np.clip(np.round(torch.as_tensor(new).cpu().numpy() * 32768), -32768, 32767).astype("<i2")
+            with open(os.path.join(dir, AUDIO_FILE), "ab") as f:
+                f.write(samples.tobytes())
+        written += new.shape[0]
+        self.segments[dir] = (written, audio_end)
+
+        starting_tokens = generation.get("starting_tokens")
+        record = {
+            "iteration": iteration,
+            "time": round(timestamp, 3),
+            "audio_start": written - length,
+            "audio_end": written,
+            "context": starting_tokens.as_text(tokenizer) if starting_tokens is not None else "",
+            "tokens": new_hypothesis,
+            "hypothesis": tokenizer.decode(new_hypothesis),
+            "frames": [p["most_attended_frames"][0] for p in generation.get("progress", [])],
+            **fields,
+        }
+        for key in ("no_speech_prob", "hallucination_detected"):
+            if generation.get(key) is not None:
+                record[key] = generation[key]
+        with open(os.path.join(dir, INDEX_FILE), "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
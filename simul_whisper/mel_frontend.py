@@ -0,0 +1,102 @@
+import torch
+import torch.nn.functional as F
+
+from .whisper.audio import N_FFT, HOP_LENGTH, N_FRAMES, mel_filters, hann_window
+
+# log10 of the clamped mel spectrum of silence, the value of all frames in the zero padding
+PADDING_LOG_SPEC = -10.0
+
+
+class IncrementalLogMel:
+    '''Log-Mel spectrogram of the streaming audio buffer, equal to whisper.audio.log_mel_spectrogram of the buffer
+    followed by zero padding, but computed incrementally.
+
+    STFT frame i is centered at sample i*HOP_LENGTH and it covers N_FFT samples around it. The log-mel frames that
+    lie completely inside the buffer do not change when new audio is appended, so they are cached. Only the last
+    few frames that reach over the end of the buffer are computed again in every call. The frames that cover only
+    the zero padding have the constant value PADDING_LOG_SPEC, so they are not computed at all.
+
+    The normalization to the maximum minus 8.0 is global, so it is applied to the whole output in every call.
+    The maximum over the buffer with padding equals the maximum over the buffer frames because the padding
+    frames have the lowest possible value.
+
+    The buffer is updated by append() and drop(), in sync with PaddedAlignAttWhisper.segments.
+    '''
+
+    def __init__(self, n_mels: int, device):
+        self.n_mels = n_mels
+        self.device = device
+        self.padding = torch.full((n_mels, N_FRAMES), PADDING_LOG_SPEC, device=device)
+        self.reset()
+
+    def reset(self):
+        self.audio = torch.zeros(0, device=self.device)
+        self.cache = torch.zeros(self.n_mels, 0, device=self.device)
+
+    def copy(self) -> "IncrementalLogMel":
+        '''Returns an independent copy of the buffer and the cache.'''
+        other = IncrementalLogMel.__new__(IncrementalLogMel)
+        other.n_mels, other.device, other.padding = self.n_mels, self.device, self.padding
+        other.audio = self.audio
+        other.cache = self.cache.clone()  # drop() updates the cache in place
+        return other
+
+    def append(self, audio: torch.Tensor):
+        self.audio = torch.cat([self.audio, torch.as_tensor(audio).to(self.device)], dim=0)
+
+    def drop(self, n_samples: int):
+        '''Removes n_samples from the beginning of the buffer.'''
+        self.audio = self.audio[n_samples:]
+        shift, rest = divmod(n_samples, HOP_LENGTH)
+        if rest != 0 or self.cache.shape[1] <= shift + 2 or self.audio.shape[0] < 2*N_FFT:
+            # the frames are not aligned with the cached ones, or there is nothing to keep
+            self.cache = self.cache[:, :0]
+            return
+        self.cache = self.cache[:, shift:]
+        # the first two frames reach over the beginning of the buffer, where STFT uses reflection padding
+        self.cache[:, :2] = self._log_spec(self.audio[:2*N_FFT], center=True)[:, :2]
+
+    @property
+    def content_frames(self):
+        '''The number of mel frames with the actual audio, as in the padded log_mel_spectrogram.'''
+        return self.audio.shape[0] // HOP_LENGTH
+
+    def _log_spec(self, audio, center):
+        stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=hann_window(audio.device), center=center, return_complex=True)
+        magnitudes = stft.abs() ** 2
+        mel_spec = mel_filters(audio.device, self.n_mels) @ magnitudes
+        return torch.clamp(mel_spec, min=1e-10).log10()
+
+    def _update(self):
+        '''Returns the log-mel frames that overlap with the buffer, not normalized, and updates the cache.'''
+        length = self.audio.shape[0]
+        # frames that overlap with the audio
+        n_touched = (length + N_FFT // 2 + HOP_LENGTH - 1) // HOP_LENGTH
+        # frames that are completely inside of the audio
+        n_final = (length - N_FFT // 2) // HOP_LENGTH + 1 if length >= N_FFT // 2 else 0
+
+        n_cached = self.cache.shape[1]
+        if n_cached * HOP_LENGTH < N_FFT // 2:
+            # nothing usable in the cache. STFT with reflection padding at the beginning, as in log_mel_spectrogram
+            padded = F.pad(self.audio, (0, n_touched * HOP_LENGTH + N_FFT - length))
+            content = self._log_spec(padded, center=True)[:, :n_touched]
+        else:
+            start = n_cached * HOP_LENGTH - N_FFT // 2
+            needed = (n_touched - n_cached - 1) * HOP_LENGTH + N_FFT
+            chunk = F.pad(self.audio[start:], (0, needed - (length - start)))
+            new = self._log_spec(chunk, center=False)
+            content = torch.cat([self.cache, new], dim=1)
+        self.cache = content[:, :n_final]
+        return content
+
+    def __call__(self, n_frames: int = N_FRAMES) -> torch.Tensor:
+        '''Returns the normalized log-mel spectrogram of the buffer padded or trimmed to n_frames,
+        shape = (n_mels, n_frames).'''
+        content = self._update()
+        log_spec = content[:, :n_frames]
+        if log_spec.shape[1] < n_frames:
+            log_spec = torch.cat([log_spec, self.padding[:, :n_frames - log_spec.shape[1]]], dim=1)
+        log_max = content.max() if content.shape[1] > 0 else self.padding[0, 0]
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec
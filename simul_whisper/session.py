@@ -0,0 +1,90 @@
+import copy
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+
+from .mel_frontend import IncrementalLogMel
+from .language import LanguageTracker
+from .whisper.tokenizer import Tokenizer
+from token_buffer import TokenBuffer
+
+
+@dataclass
+class SessionState:
+    '''The mutable state of one audio stream that is decoded by PaddedAlignAttWhisper.
+
+    The model, the KV cache and the attention of the alignment heads are shared by all sessions of one
+    PaddedAlignAttWhisper. The caches are cleaned after every generation, so a session only keeps the audio buffer,
+    the decoded tokens and the context. Create it by PaddedAlignAttWhisper.new_session().
+    '''
+    tokenizer: Tokenizer
+    # log-mel spectrogram of the concatenated segments, updated incrementally
+    mel_frontend: IncrementalLogMel
+    detected_language: Optional[str] = None
+    # the language over the utterances, with --lan auto
+    language_tracker: Optional[LanguageTracker] = None
+    segments: List[torch.Tensor] = field(default_factory=list)
+    # forced tokens of the generation and the decoded tokens of the segments in the audio buffer
+    tokens: List[torch.Tensor] = field(default_factory=list)
+    # text that is not in the audio buffer anymore, the prompt
+    context: TokenBuffer = None
+    initial_tokens: torch.Tensor = None
+    initial_token_length: int = 0
+    sot_index: int = 0
+    last_attend_frame: int = 0
+    # the number of samples inserted to the session, and the logdir segment directory of the current utterance
+    audio_end: int = 0
+    session_id: int = 0
+    log_segment: int = 0
+
+    def snapshot(self) -> "SessionState":
+        '''Returns a copy of the state that is not affected by further processing of this session.
+        The tensors are shared because they are never modified in place.'''
+        return SessionState(
+            tokenizer=self.tokenizer,
+            mel_frontend=self.mel_frontend.copy(),
+            detected_language=self.detected_language,
+            language_tracker=copy.deepcopy(self.language_tracker),
+            segments=list(self.segments),
+            tokens=list(self.tokens),
+            context=self.context.copy(),
+            initial_tokens=self.initial_tokens,
+            initial_token_length=self.initial_token_length,
+            sot_index=self.sot_index,
+            last_attend_frame=self.last_attend_frame,
+            audio_end=self.audio_end,
+            session_id=self.session_id,
+            log_segment=self.log_segment,
+        )
+
+
+@dataclass
+class DecodingJob:
+    '''One generation of PaddedAlignAttWhisper for a session, i.e. the decoding loop of one infer() call.
+
+    The loop is split to the steps in PaddedAlignAttWhisper._start_job, _job_step and _finish_job, so that the
+    decoder forward passes of many jobs can be batched by DecodeEngine.
+    '''
+    state: SessionState
+    is_last: bool
+    input_segments: torch.Tensor
+    encoder_feature: torch.Tensor
+    content_mel_len: int
+    # GreedyDecoder or BeamSearchDecoder
+    token_decoder: object = None
+    # AlignmentTracker, the cross-attention of the alignment heads
+    alignment: object = None
+    current_tokens: Optional[torch.Tensor] = None
+    sum_logprobs: Optional[torch.Tensor] = None
+    token_len_before_decoding: int = 0
+    fire_detected: bool = False
+    generation: Optional[dict] = None
+    new_segment: bool = True
+    completed: bool = False
+    done: bool = False
+    # DecodeEngine: the rows of the job in the cache, the number of cached tokens, the cross-attention keys and values
+    rows: Optional[torch.Tensor] = None
+    length: int = 0
+    cross_keys: Optional[list] = None
+    cross_values: Optional[list] = None
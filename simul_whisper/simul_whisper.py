@@ -2,17 +2,28 @@
 
 import os
 import logging
+import threading
+import itertools
+from functools import partial
 
 import torch
 import torch.nn.functional as F
 
 from .whisper import load_model, DecodingOptions, tokenizer
+from .whisper.model import MultiHeadAttention
 from .config import AlignAttConfig
-from .whisper.audio import log_mel_spectrogram, TOKENS_PER_SECOND, pad_or_trim, N_SAMPLES, N_FRAMES
-from .whisper.timing import median_filter
+from .whisper.audio import TOKENS_PER_SECOND, N_FRAMES
 from .whisper.decoding import GreedyDecoder, BeamSearchDecoder, SuppressTokens, detect_language
 from .beam import BeamPyTorchInference
+from .kv_cache import StaticKVCache
+from .alignment import AlignmentTracker
 from .eow_detection import fire_at_boundary, load_cif
+from .mel_frontend import IncrementalLogMel
+from .session import SessionState, DecodingJob
+from .language import LanguageTracker
+from .logdir_recorder import LogdirRecorder
+from .encoder_batcher import EncoderBatcher
+from .decode_engine import DecodeEngine
 from token_buffer import TokenBuffer
 
 import numpy as np
@@ -22,7 +33,6 @@ DEC_PAD = 50257
 logger = logging.getLogger(__name__)
 
 import sys
-import wave
 
 # New features added to the original version of Simul-Whisper: 
 # - large-v3 model support
@@ -93,9 +103,12 @@ def calculate_compression_ratio(text: str) -> float:
 class PaddedAlignAttWhisper:
     def __init__(self, cfg: AlignAttConfig) -> None:
         self.logdir_i = 0
-        self.log_segments = 0
-        if cfg.logdir is not None and not os.path.exists(cfg.logdir):
-            os.makedirs(cfg.logdir)
+        self.log_segments = itertools.count()  # the numbers of the logdir segment directories
+        self.session_ids = itertools.count()
+        if cfg.logdir is not None:
+            self.logdir_recorder = LogdirRecorder(cfg.logdir, cfg.logdir_queue_size)
+        else:
+            self.logdir_recorder = None
         model_name = os.path.basename(cfg.model_path).replace(".pt", "")
         model_path = os.path.dirname(os.path.abspath(cfg.model_path))
         self.model = load_model(name=model_name, download_root=model_path)
@@ -108,8 +121,16 @@ class PaddedAlignAttWhisper:
             task=cfg.task
         )
         self.tokenizer_is_multilingual = not model_name.endswith(".en")
-        self.create_tokenizer(cfg.language if cfg.language != "auto" else None)
-        self.detected_language = cfg.language if cfg.language != "auto" else None
+        # the tokenizer of the configured language. The special tokens are the same for all languages.
+        self.tokenizer = self.create_tokenizer(cfg.language if cfg.language != "auto" else None)
+        # the languages that the language identification chooses from
+        self.language_candidates = list(zip(self.tokenizer.all_language_tokens, self.tokenizer.all_language_codes))
+        if cfg.language_candidates is not None:
+            codes = [c.strip() for c in cfg.language_candidates.split(",") if c.strip()]
+            unknown = [c for c in codes if c not in self.tokenizer.all_language_codes]
+            if unknown or not codes:
+                raise ValueError(f"Invalid language candidates: {cfg.language_candidates}")
+            self.language_candidates = [(t, c) for t, c in self.language_candidates if c in codes]
         
         self.max_text_len = self.model.dims.n_text_ctx
         self.num_decoder_layers = len(self.model.decoder.blocks)
@@ -120,31 +141,6 @@ class PaddedAlignAttWhisper:
                                                                      n_audio_state=self.model.dims.n_audio_state,
                                                                      device=self.model.device)
 
-        # install hooks to access encoder-decoder attention
-        self.dec_attns = []
-        def layer_hook(module, net_input, net_output):
-            # net_output[1]: B*num_head*token_len*audio_len
-            t = F.softmax(net_output[1], dim=-1)
-            self.dec_attns.append(t.squeeze(0))
-        for b in self.model.decoder.blocks:
-            b.cross_attn.register_forward_hook(layer_hook)
-        
-        self.kv_cache = {}
-        def kv_hook(module: torch.nn.Linear, _, net_output: torch.Tensor):
-            if module.cache_id not in self.kv_cache or net_output.shape[1] > self.max_text_len:
-                # save as-is, for the first token or cross attention
-                self.kv_cache[module.cache_id] = net_output
-            else:
-                x = self.kv_cache[module.cache_id]
-                self.kv_cache[module.cache_id] = torch.cat([x, net_output], dim=1).detach()
-            return self.kv_cache[module.cache_id] 
-
-        for i,b in enumerate(self.model.decoder.blocks):
-            b.attn.key.register_forward_hook(kv_hook)
-            b.attn.value.register_forward_hook(kv_hook)
-            b.cross_attn.key.register_forward_hook(kv_hook)
-            b.cross_attn.value.register_forward_hook(kv_hook)
-
         self.align_source = {}
         self.num_align_heads = 0
         for layer_rank, head_id in self.model.alignment_heads.indices().T:
@@ -154,6 +150,42 @@ class PaddedAlignAttWhisper:
             self.align_source[layer_rank] = heads
             self.num_align_heads += 1
 
+        # Only the cross-attention layers with alignment heads return the attention logits, and only for those heads.
+        # All the other attention uses the fused scaled_dot_product_attention, unless it is disabled.
+        for module in self.model.modules():
+            if isinstance(module, MultiHeadAttention):
+                module.use_sdpa = cfg.sdpa
+        self.returned_heads = {}  # layer rank -> list of (alignment head rank, index in the returned logits)
+        for layer_rank, heads in self.align_source.items():
+            self.model.decoder.blocks[layer_rank].cross_attn.qk_heads = [head_id for _, head_id in heads]
+            self.returned_heads[layer_rank] = [(align_head_rank, i) for i, (align_head_rank, _) in enumerate(heads)]
+
+        # install hooks to access encoder-decoder attention of the alignment heads
+        self.alignment = AlignmentTracker(self.returned_heads, self.num_align_heads)
+        def layer_hook(module, net_input, net_output, layer_rank):
+            # net_output[1]: B*num_head*token_len*audio_len
+            self.alignment.update(layer_rank, net_output[1])
+        for i, b in enumerate(self.model.decoder.blocks):
+            if i in self.align_source:
+                b.cross_attn.register_forward_hook(partial(layer_hook, layer_rank=i))
+
+        self.kv_cache = StaticKVCache(self.model.dims.n_text_ctx)
+        self_attn_cache_ids = set()
+        for b in self.model.decoder.blocks:
+            self_attn_cache_ids.update([b.attn.key.cache_id, b.attn.value.cache_id])
+        def kv_hook(module: torch.nn.Linear, _, net_output: torch.Tensor):
+            if module.cache_id in self_attn_cache_ids:
+                # written in place after the previous tokens
+                return self.kv_cache.append(module.cache_id, net_output.detach())
+            # cross attention is computed only once per generation, save as-is
+            self.kv_cache[module.cache_id] = net_output
+            return net_output
+
+        for i,b in enumerate(self.model.decoder.blocks):
+            b.attn.key.register_forward_hook(kv_hook)
+            b.attn.value.register_forward_hook(kv_hook)
+            b.cross_attn.key.register_forward_hook(kv_hook)
+            b.cross_attn.value.register_forward_hook(kv_hook)
 
         # tokens to be suppressed from decoding, to prevent hallucinations
         suppress_tokens = [
@@ -173,17 +205,25 @@ class PaddedAlignAttWhisper:
         self.suppress_tokens = lambda logits: sup_tokens.apply(logits, None)
         # blank tokens are suppresed for new segments near the line 334
 
-        # it's going to be regenerated after lang id
-        self.segments = []
-        self.init_tokens()
-        
-        self.last_attend_frame = -self.cfg.rewind_threshold
-
         if self.cfg.max_context_tokens is None:
             self.max_context_tokens = self.max_text_len
         else:
             self.max_context_tokens = self.cfg.max_context_tokens
-        self.init_context()
+
+        # the default session, used when no session is passed to infer(), insert_audio() and refresh_segment()
+        self.state = self.new_session()
+        # serializes the generations of all sessions, because they share the model and the caches
+        self.lock = threading.RLock()
+        # batches the encoder inputs of concurrent sessions
+        if cfg.encoder_batch_size > 1:
+            self.encoder_batcher = EncoderBatcher(self.model.encoder, cfg.encoder_batch_size, cfg.encoder_batch_wait)
+        else:
+            self.encoder_batcher = None
+        # batches the decoding steps of concurrent sessions
+        if cfg.decode_batch_size > 1:
+            self.decode_engine = DecodeEngine(self, cfg.decode_batch_size)
+        else:
+            self.decode_engine = None
 
         # decoder type: greedy or beam
         if cfg.decoder_type == "greedy":
@@ -193,90 +233,108 @@ class PaddedAlignAttWhisper:
 
         elif cfg.decoder_type == "beam":
             self.decoder_type = "beam"
-            self.inference = BeamPyTorchInference(self.model, self.initial_token_length)
+            self.inference = BeamPyTorchInference(self.model, self.state.initial_token_length)
             self.inference.kv_cache = self.kv_cache
 
             self.token_decoder = BeamSearchDecoder(inference=self.inference, eot=self.tokenizer.eot, beam_size=cfg.beam_size)
 
     def create_tokenizer(self, language=None):
-        self.tokenizer = tokenizer.get_tokenizer(
+        return tokenizer.get_tokenizer(
             multilingual=self.tokenizer_is_multilingual,  
             language=language,
             num_languages=self.model.num_languages,
             task=self.decode_options.task
         )
 
-    def init_context(self):
-        kw = {'tokenizer': self.tokenizer, 
+    def new_session(self) -> SessionState:
+        """Creates the state of a new audio stream."""
+        language = self.cfg.language if self.cfg.language != "auto" else None
+        state = SessionState(
+            tokenizer=self.create_tokenizer(language),
+            mel_frontend=IncrementalLogMel(self.model.dims.n_mels, self.model.device),
+            detected_language=language,
+            language_tracker=LanguageTracker(self.cfg.language_confirm_utterances, self.cfg.language_confirm_prob,
+                                             self.cfg.language_recheck_interval),
+            last_attend_frame=-self.cfg.rewind_threshold,
+            session_id=next(self.session_ids),
+            log_segment=next(self.log_segments),
+        )
+        self.init_tokens(state)
+        self.init_context(state)
+        return state
+
+    def init_context(self, state):
+        kw = {'tokenizer': state.tokenizer, 
               'device': self.model.device, 
-              'prefix_token_ids': [self.tokenizer.sot_prev]}
-        self.context = TokenBuffer.empty(**kw)
-        if self.cfg.static_init_prompt is not None:
-            self.context = TokenBuffer.from_text(self.cfg.static_init_prompt, **kw)
+              'prefix_token_ids': [state.tokenizer.sot_prev]}
+        state.context = TokenBuffer.empty(static_text=self.cfg.static_init_prompt or "", **kw)
         if self.cfg.init_prompt is not None:
-            self.context.text += self.cfg.init_prompt
+            state.context.append_text(self.cfg.init_prompt)
 
-    def init_tokens(self):
-        logger.debug(f"init tokens, {len(self.segments)}")
+    def init_tokens(self, state):
+        logger.debug(f"init tokens, {len(state.segments)}")
         # init tokens (mandatory prompt)
-        self.initial_tokens = torch.tensor(
-            self.tokenizer.sot_sequence_including_notimestamps, 
+        state.initial_tokens = torch.tensor(
+            state.tokenizer.sot_sequence_including_notimestamps, 
             dtype=torch.long, 
             device=self.model.device).unsqueeze(0)
-        self.initial_token_length = self.initial_tokens.shape[1]
-        self.sot_index = self.tokenizer.sot_sequence.index(self.tokenizer.sot)
-#        self.segments = []
-        logger.debug(f"init tokens after, {len(self.segments)}")
-        self.tokens = [self.initial_tokens]
+        state.initial_token_length = state.initial_tokens.shape[1]
+        state.sot_index = state.tokenizer.sot_sequence.index(state.tokenizer.sot)
+#        state.segments = []
+        logger.debug(f"init tokens after, {len(state.segments)}")
+        state.tokens = [state.initial_tokens]
 
-    def trim_context(self):
+    def trim_context(self, state):
         logger.info("Trimming context")
-        c = len(self.context.as_token_ids()) - len(self.context.prefix_token_ids)
-#        logger.debug(f"c= {len(self.context.as_token_ids())}, {len(self.context.prefix_token_ids)}")
-        logger.info(f"Context text: {self.context.as_text()}")
-#        logger.debug(f"Context tensor: {self.context.as_tensor()}")
-        l = sum(t.shape[1] for t in self.tokens) + c
-#        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
-        if self.cfg.static_init_prompt is None:
-            after = 0
-        else:
-            after = len(self.cfg.static_init_prompt)
+        c = state.context.n_tokens
+#        logger.debug(f"c= {len(state.context.as_token_ids())}, {len(state.context.prefix_token_ids)}")
+        logger.info(f"Context text: {state.context.as_text()}")
+#        logger.debug(f"Context tensor: {state.context.as_tensor()}")
+        l = sum(t.shape[1] for t in state.tokens) + c
 #        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
         while c > self.max_context_tokens or l > self.max_text_len - 20:
-            t = self.context.trim_words(after=after)
+            # the static init prompt is never trimmed
+            t = state.context.trim_words()
             l -= t
             c -= t
             logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
             if t == 0:
                 break
 #        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
-        logger.info(f"Context after trim: {self.context.text} (len: {l})")
+        logger.info(f"Context after trim: {state.context.text} (len: {l})")
 
 
-    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
+    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor, logit_positions=None) -> torch.Tensor:
         if self.cfg.decoder_type == "greedy":
-            logit = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+            logit = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache, logit_positions=logit_positions)
         else:
             logger.debug(f"Logits shape: {tokens.shape}")
-            logit = self.inference.logits(tokens, audio_features)
+            logit = self.inference.logits(tokens, audio_features, logit_positions=logit_positions)
         return logit
     
 
-    def refresh_segment(self, complete=False):
+    def refresh_segment(self, complete=False, state=None):
+        if state is None:
+            state = self.state
 
         logger.debug("Refreshing segment:")
-        self.init_tokens()
-        self.last_attend_frame = -self.cfg.rewind_threshold       
-        self.detected_language = None
-        self.init_context()
-        logger.debug(f"Context: {self.context}")
-        if not complete and len(self.segments) > 2:
+        self.init_tokens(state)
+        state.last_attend_frame = -self.cfg.rewind_threshold       
+        # with --lan auto, the confirmed language is reused in the next utterance
+        state.language_tracker.next_utterance()
+        if state.language_tracker.needs_detection():
+            state.detected_language = None
+        self.init_context(state)
+        logger.debug(f"Context: {state.context}")
+        if not complete and len(state.segments) > 2:
             logger.debug("keeping last two segments because they are and it is not complete.")
-            self.segments = self.segments[-2:]
+            state.mel_frontend.drop(sum(s.shape[0] for s in state.segments[:-2]))
+            state.segments = state.segments[-2:]
         else:
             logger.debug("removing all segments.")
-            self.segments = []
-        self.log_segments += 1
+            state.segments = []
+            state.mel_frontend.reset()
+        state.log_segment = next(self.log_segments)
 
 
     def fire_at_boundary(self, chunked_encoder_feature: torch.Tensor):
@@ -285,15 +343,15 @@ class PaddedAlignAttWhisper:
         return fire_at_boundary(chunked_encoder_feature, self.CIFLinear)
 
 
-    def _current_tokens(self):
+    def _current_tokens(self, state):
 
-        toks = self.tokens
+        toks = state.tokens
         # very first infer: duplicate start of seq to beam_size
         if toks[0].shape[0] == 1:
             toks[0] = toks[0].repeat_interleave(self.cfg.beam_size,dim=0)
 
-        if not self.context.is_empty():
-            context_toks = self.context.as_tensor_beam(self.cfg.beam_size, device=self.model.device)
+        if not state.context.is_empty():
+            context_toks = state.context.as_tensor_beam(self.cfg.beam_size, device=self.model.device)
             toks = [context_toks] + toks
 
         # make it one tensor
@@ -302,54 +360,76 @@ class PaddedAlignAttWhisper:
         else:
             current_tokens = toks[0]
         logger.debug("debug print current_tokens:")
-        self.debug_print_tokens(current_tokens)
+        self.debug_print_tokens(state, current_tokens)
         return current_tokens
 
 
-    def debug_print_tokens(self, tokens):
+    def debug_print_tokens(self, state, tokens):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         for i in range(self.cfg.beam_size):
-            logger.debug(self.tokenizer.decode_with_timestamps(tokens[i].tolist()))
+            logger.debug(state.tokenizer.decode_with_timestamps(tokens[i].tolist()))
 
     ### audio buffer 
 
-    def segments_len(self):
-        segments_len = sum(s.shape[0] for s in self.segments) / 16000
+    def segments_len(self, state):
+        segments_len = sum(s.shape[0] for s in state.segments) / 16000
         return segments_len
 
-    def _apply_minseglen(self):
-        segments_len = self.segments_len()
+    def _apply_minseglen(self, state):
+        segments_len = self.segments_len(state)
         # wait for long enough audio to start
         if segments_len < self.cfg.audio_min_len: 
             logger.debug("waiting for next segment")
             return False
         return True
 
-    def insert_audio(self, segment=None):
+    def insert_audio(self, segment=None, state=None):
+        if state is None:
+            state = self.state
         if segment is not None:
-            self.segments.append(segment)
+            state.segments.append(segment)
+            state.mel_frontend.append(segment)
+            state.audio_end += segment.shape[0]
 
         removed_len = 0
         # len of audio is bigger than buffer_len. Going to remove the first segment
-        segments_len = self.segments_len()
-        while len(self.segments) > 1 and segments_len > self.cfg.audio_max_len:
-            removed_len = self.segments[0].shape[0] / 16000
+        segments_len = self.segments_len(state)
+        while len(state.segments) > 1 and segments_len > self.cfg.audio_max_len:
+            removed_len = state.segments[0].shape[0] / 16000
             segments_len -= removed_len
-            self.last_attend_frame -= int(TOKENS_PER_SECOND*removed_len)
-            self.segments = self.segments[1:]
-            logger.debug(f"remove segments: {len(self.segments)} {len(self.tokens)}")
-            if len(self.tokens) > 1:
-                self.context.append_token_ids(self.tokens[1][0,:])
-                self.tokens = [self.initial_tokens] + self.tokens[2:]
+            state.last_attend_frame -= int(TOKENS_PER_SECOND*removed_len)
+            state.mel_frontend.drop(state.segments[0].shape[0])
+            state.segments = state.segments[1:]
+            logger.debug(f"remove segments: {len(state.segments)} {len(state.tokens)}")
+            if len(state.tokens) > 1:
+                state.context.append_token_ids(state.tokens[1][0,:])
+                state.tokens = [state.initial_tokens] + state.tokens[2:]
         return removed_len
 
+    def _mel(self, state):
+        '''Returns the mel spectrogram of the audio buffer for the encoder and the number of encoder frames
+        with the actual audio.
+
+        By default, the audio is padded to 30 seconds. In the short context mode, the audio is followed only by
+        cfg.short_context_margin encoder frames of zero padding. The encoder slices its positional embedding to the
+        input length, as in whisper/trans_nopad.py, so it processes only these frames.'''
+        content_frames = state.mel_frontend.content_frames
+        if self.cfg.short_context:
+            n_frames = min(content_frames + 2*self.cfg.short_context_margin, N_FRAMES)
+            n_frames += n_frames % 2  # the encoder's convolution has stride 2
+        else:
+            n_frames = N_FRAMES
+        mel = state.mel_frontend(n_frames).unsqueeze(0)
+        return mel, content_frames // 2
+
     def _clean_cache(self):
         '''clean the cache that stores the attention matrices and kv_cache.
         It must be called every time after generation with the model.'''
         # cleaning cache
-        self.dec_attns = []
-        self.kv_cache = {}
+        self.alignment.reset()
+        self.kv_cache.reset()
         if self.decoder_type == "beam":
-            self.inference.kv_cache = self.kv_cache
             self.token_decoder.reset()
 
     @torch.no_grad()
@@ -364,15 +444,16 @@ class PaddedAlignAttWhisper:
         logits = self.model.logits(x, encoder_features)[:, 0]
 
         # collect detected languages; suppress all non-language tokens
+        # and the languages that are not candidates
         mask = torch.ones(logits.shape[-1], dtype=torch.bool)
-        mask[list(self.tokenizer.all_language_tokens)] = False
+        mask[[j for j, _ in self.language_candidates]] = False
         logits[:, mask] = -np.inf
         language_tokens = logits.argmax(dim=-1)
         language_token_probs = logits.softmax(dim=-1).cpu()
         language_probs = [
             {
                 c: language_token_probs[i, j].item()
-                for j, c in zip(self.tokenizer.all_language_tokens, self.tokenizer.all_language_codes)
+                for j, c in self.language_candidates
             }
             for i in range(n_audio)
         ]
@@ -388,77 +469,106 @@ class PaddedAlignAttWhisper:
     ### transcription / translation
 
     @torch.no_grad()
-    def infer(self, is_last=False):
-        new_segment = True
-        if len(self.segments) == 0:
+    def infer(self, is_last=False, state=None):
+        if state is None:
+            state = self.state
+        if len(state.segments) == 0:
             logger.debug("No segments, nothing to do")
-            self.logdir_save([], [], {})
+            with self.lock:
+                self.logdir_save(state, [], [], {}, is_last)
             return [], {}
-        if not self._apply_minseglen():
-            logger.debug(f"applied minseglen {self.cfg.audio_min_len} > {self.segments_len()}.")
-            input_segments = torch.cat(self.segments, dim=0)
-            self.logdir_save(input_segments, [], {})
+        # input_segments is concatenation of audio, it's one array
+        input_segments = state.mel_frontend.audio
+        if not self._apply_minseglen(state):
+            logger.debug(f"applied minseglen {self.cfg.audio_min_len} > {self.segments_len(state)}.")
+            with self.lock:
+                self.logdir_save(state, input_segments, [], {}, is_last)
             return [], {}
 
-        # input_segments is concatenation of audio, it's one array
-        if len(self.segments) > 1:
-            input_segments = torch.cat(self.segments, dim=0)
-        else:
-            input_segments = self.segments[0]
+        # mel + padding, and the len of actual audio
+        mel, content_mel_len = self._mel(state)
 
+        # encode. The encoder has no state, so with batching it runs outside of the lock, batched with other sessions.
+        encoder_feature = self.encode(mel)
 
-        
-        # mel + padding to 30s
-        mel_padded = log_mel_spectrogram(input_segments, n_mels=self.model.dims.n_mels, padding=N_SAMPLES, 
-                                            device=self.model.device).unsqueeze(0)
-        # trim to 3000
-        mel = pad_or_trim(mel_padded, N_FRAMES)
+        if self.decode_engine is not None:
+            job = DecodingJob(state=state, is_last=is_last, input_segments=input_segments,
+                              encoder_feature=encoder_feature, content_mel_len=content_mel_len)
+            return self.decode_engine.decode(job)
+        with self.lock:
+            return self._decode(state, is_last, input_segments, encoder_feature, content_mel_len)
+
+    def encode(self, mel: torch.Tensor) -> torch.Tensor:
+        if self.encoder_batcher is not None:
+            return self.encoder_batcher.encode(mel)
+        # without batching, the encoder of the concurrent sessions is serialized, so they do not oversubscribe the
+        # intra-op threads of torch
+        with self.lock:
+            return self.model.encoder(mel)
+
+    @torch.no_grad()
+    def _decode(self, state, is_last, input_segments, encoder_feature, content_mel_len):
+        job = DecodingJob(state=state, is_last=is_last, input_segments=input_segments, encoder_feature=encoder_feature,
+                          content_mel_len=content_mel_len, token_decoder=self.token_decoder, alignment=self.alignment)
+        self._start_job(job)
+        while not job.done:
+            tokens_for_logits, logit_positions = self._job_input(job)
+            logits = self.logits(tokens_for_logits, job.encoder_feature, logit_positions) # B, len(logit_positions) or 1, token dict size
+            self._job_step(job, logits)
+        new_hypothesis, generation = self._finish_job(job)
+
+        self._clean_cache()
 
-        # the len of actual audio
-        content_mel_len = int((mel_padded.shape[2] - mel.shape[2])/2)
+        self.logdir_save(state, input_segments, new_hypothesis, generation, is_last)
+        return new_hypothesis, generation
 
-        # encode
-        encoder_feature = self.model.encoder(mel)
+    def _start_job(self, job: DecodingJob):
+        '''The part of the generation before the decoding loop: language identification, the forced tokens and the
+        context, and the end of word detection.'''
+        state = job.state
+        encoder_feature = job.encoder_feature
+        content_mel_len = job.content_mel_len
 
 #        logger.debug(f"Encoder feature shape: {encoder_feature.shape}")
 #        if mel.shape[-2:] != (self.model.dims.n_audio_ctx, self.model.dims.n_audio_state):
 #            logger.debug("mel ")
-        if self.cfg.language == "auto" and self.detected_language is None:
+        if self.cfg.language == "auto" and state.detected_language is None:
             language_tokens, language_probs = self.lang_id(encoder_feature) 
             logger.debug(f"Language tokens: {language_tokens}, probs: {language_probs}")
-            top_lan, p = max(language_probs[0].items(), key=lambda x: x[1])
-            logger.info(f"Detected language: {top_lan} with p={p:.4f}")
-            #self.tokenizer.language = top_lan
-            #self.tokenizer.__post_init__()
-            self.create_tokenizer(top_lan)
-            self.detected_language = top_lan
-            self.init_tokens()
-            logger.info(f"Tokenizer language: {self.tokenizer.language}, {self.tokenizer.sot_sequence_including_notimestamps}")
-
-        self.trim_context()
-        current_tokens = self._current_tokens()
+            top_lan = state.language_tracker.observe(language_probs[0])
+            logger.info(f"Detected language: {top_lan} with p={language_probs[0][top_lan]:.4f}")
+            #state.tokenizer.language = top_lan
+            #state.tokenizer.__post_init__()
+            state.tokenizer = self.create_tokenizer(top_lan)
+            state.detected_language = top_lan
+            self.init_tokens(state)
+            logger.info(f"Tokenizer language: {state.tokenizer.language}, {state.tokenizer.sot_sequence_including_notimestamps}")
+
+        self.trim_context(state)
+        current_tokens = self._current_tokens(state)
 #        
-        fire_detected = self.fire_at_boundary(encoder_feature[:, :content_mel_len, :])
+        job.fire_detected = self.fire_at_boundary(encoder_feature[:, :content_mel_len, :])
+
+        if self.cfg.decoder_frames_margin is not None:
+            # The decoder attends only to the real audio frames and a margin. The frame indices start at 0 as before,
+            # so the most attended frames and the frame_threshold check are not affected.
+            job.encoder_feature = encoder_feature[:, :content_mel_len + self.cfg.decoder_frames_margin, :]
 
 
         ####################### Decoding loop
         logger.info("Decoding loop starts\n")
 
-        sum_logprobs = torch.zeros(self.cfg.beam_size, device=mel.device)
-        completed = False
+        job.sum_logprobs = torch.zeros(self.cfg.beam_size, device=encoder_feature.device)
+        job.completed = False
 
-        attn_of_alignment_heads = None
-        most_attended_frame = None
-
-        token_len_before_decoding = current_tokens.shape[1]
+        job.token_len_before_decoding = current_tokens.shape[1]
+        job.current_tokens = current_tokens
         
-        generation_progress = []
-        generation = {
-            "starting_tokens": BeamTokens(current_tokens[0,:].clone(), self.cfg.beam_size),
-            "token_len_before_decoding": token_len_before_decoding,
+        job.generation = {
+            "token_len_before_decoding": job.token_len_before_decoding,
             #"fire_detected": fire_detected,
             "frames_len": content_mel_len,
-            "frames_threshold": 4 if is_last else self.cfg.frame_threshold,
+            "frames_threshold": 4 if job.is_last else self.cfg.frame_threshold,
 
             # to be filled later
             "logits_starting": None,
@@ -468,150 +578,156 @@ class PaddedAlignAttWhisper:
             "no_speech": False,
 
             # to be filled in the loop
-            "progress": generation_progress,
+            "progress": [],
         }
-        while not completed and current_tokens.shape[1] < self.max_text_len: # bos is 3 tokens
-            generation_progress_loop = []
-
-            if new_segment:
-                tokens_for_logits = current_tokens
-            else:
-                # only need to use the last token except in the first forward pass
-                tokens_for_logits = current_tokens[:,-1:]
-
-            logits = self.logits(tokens_for_logits, encoder_feature) # B, len(tokens), token dict size
-            if new_segment:
-                generation["logits_starting"] = Logits(logits[:,:,:])
-
-            if new_segment and self.tokenizer.no_speech is not None:
-                probs_at_sot = logits[:, self.sot_index, :].float().softmax(dim=-1)
-                no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
-                generation["no_speech_prob"] = no_speech_probs[0]
-                if no_speech_probs[0] > self.cfg.nonspeech_prob:
-                    generation["no_speech"] = True
-                    logger.info("no speech, stop")
-                    break
-
-            logits = logits[:, -1, :] # logits for the last token
+        if self.cfg.telemetry != "minimal":
+            job.generation["starting_tokens"] = BeamTokens(current_tokens[0,:].clone(), self.cfg.beam_size)
+        job.done = not current_tokens.shape[1] < self.max_text_len # bos is 3 tokens
+
+    def _job_input(self, job: DecodingJob):
+        '''The tokens for the next decoder forward pass, and the positions to compute the logits for.'''
+        if job.new_segment:
+            # the logits are needed only at sot_index for no_speech, and for the last token
+            return job.current_tokens, [job.state.sot_index, -1]
+        # only need to use the last token except in the first forward pass
+        return job.current_tokens[:,-1:], None
+
+    def _job_step(self, job: DecodingJob, logits: torch.Tensor):
+        '''One step of the decoding loop, after the decoder forward pass. It selects the next tokens and applies
+        the AlignAtt policy. It sets job.done when the loop ends.'''
+        state = job.state
+        generation = job.generation
+        current_tokens = job.current_tokens
+        sum_logprobs = job.sum_logprobs
+        content_mel_len = job.content_mel_len
+        job.done = True  # set back at the end of the step if the loop continues
+        # the telemetry level: the trace of the step in generation["progress"]
+        trace = self.cfg.telemetry != "minimal"
+        trace_logits = self.cfg.telemetry == "full"
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        generation_progress_loop = []
+
+        if job.new_segment and trace_logits:
+            generation["logits_starting"] = Logits(logits[:,:,:])
+
+        if job.new_segment and state.tokenizer.no_speech is not None:
+            probs_at_sot = logits[:, 0, :].float().softmax(dim=-1)
+            no_speech_probs = probs_at_sot[:, state.tokenizer.no_speech].tolist()
+            generation["no_speech_prob"] = no_speech_probs[0]
+            if no_speech_probs[0] > self.cfg.nonspeech_prob:
+                generation["no_speech"] = True
+                logger.info("no speech, stop")
+                return
+
+        logits = logits[:, -1, :] # logits for the last token
+        if trace_logits:
             generation_progress_loop.append(("logits_before_suppress",Logits(logits)))
 
-            # supress blank tokens only at the beginning of the segment
-            if new_segment:
-                logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
-            new_segment = False
-            self.suppress_tokens(logits)
-            #generation_progress_loop.append(("logits_after_suppres",BeamLogits(logits[0,:].clone(), self.cfg.beam_size)))
+        # supress blank tokens only at the beginning of the segment
+        if job.new_segment:
+            logits[:, state.tokenizer.encode(" ") + [state.tokenizer.eot]] = -np.inf
+        job.new_segment = False
+        self.suppress_tokens(logits)
+        #generation_progress_loop.append(("logits_after_suppres",BeamLogits(logits[0,:].clone(), self.cfg.beam_size)))
+        if trace_logits:
             generation_progress_loop.append(("logits_after_suppress",Logits(logits)))
 
-            current_tokens, completed = self.token_decoder.update(current_tokens, logits, sum_logprobs)
+        current_tokens, completed = job.token_decoder.update(current_tokens, logits, sum_logprobs)
+        job.current_tokens, job.completed = current_tokens, completed
+        if trace:
             generation_progress_loop.append(("beam_tokens",Tokens(current_tokens[:,-1].clone())))
             generation_progress_loop.append(("sum_logprobs",sum_logprobs.tolist()))
             generation_progress_loop.append(("completed",completed))
 
+        if debug:
             logger.debug(f"Decoding completed: {completed}, sum_logprobs: {sum_logprobs.tolist()}, tokens: ")
-            self.debug_print_tokens(current_tokens)
-
-            # Anti-hallucination: Check for repetition in newly generated tokens
-            new_tokens_so_far = current_tokens[0, token_len_before_decoding:].tolist()
-            if detect_repetition(new_tokens_so_far, self.cfg.max_repeat_tokens, self.cfg.max_repeat_ngram):
-                logger.warning("Hallucination detected (repetition), stopping generation")
-                # Remove repeated tokens - keep only first occurrence
-                current_tokens = current_tokens[:, :token_len_before_decoding]
-                generation["hallucination_detected"] = "repetition"
-                break
-            
-            # Anti-hallucination: Check max tokens per segment
-            if hasattr(self.cfg, 'max_tokens_per_segment') and self.cfg.max_tokens_per_segment > 0:
-                if len(new_tokens_so_far) >= self.cfg.max_tokens_per_segment:
-                    logger.warning(f"Max tokens per segment ({self.cfg.max_tokens_per_segment}) reached, stopping")
-                    generation["hallucination_detected"] = "max_tokens"
-                    break
-
-
-            # if self.decoder_type == "beam":
-            #     logger.debug(f"Finished sequences: {self.token_decoder.finished_sequences}")
-
-            #     logprobs = F.log_softmax(logits.float(), dim=-1)
-            #     idx = 0
-            #     logger.debug(f"Beam search topk: {logprobs[idx].topk(self.cfg.beam_size + 1)}")
-            #     logger.debug(f"Greedy search argmax: {logits.argmax(dim=-1)}")
-            # if completed:
-            #     self.debug_print_tokens(current_tokens)
-
-            #     logger.debug("decode stopped because decoder completed")
-
-            attn_of_alignment_heads = [[] for _ in range(self.num_align_heads)]
-            for i, attn_mat in enumerate(self.dec_attns):
-                layer_rank = int(i % len(self.model.decoder.blocks))
-                align_heads_in_layer = self.align_source.get(layer_rank, [])
-                if len(align_heads_in_layer) == 0:
-                    continue
-                for align_head_rank, head_id in align_heads_in_layer:
-                    if self.cfg.beam_size == 1:
-                        a = attn_mat[head_id, :, :]
-                        a = a.unsqueeze(0)
-                    else:
-                        a = attn_mat[:, head_id, :, :]
-                    attn_of_alignment_heads[align_head_rank].append(a)
-            tmp = []
-            for mat in attn_of_alignment_heads:
-                t = torch.cat(mat, dim=1)
-                tmp.append(t) 
-            attn_of_alignment_heads = torch.stack(tmp, dim=1)
-#            logger.debug(str(attn_of_alignment_heads.shape) + " tttady")
-            std, mean = torch.std_mean(attn_of_alignment_heads, dim=-2, keepdim=True, unbiased=False)
-            attn_of_alignment_heads = (attn_of_alignment_heads - mean) / std
-            attn_of_alignment_heads = median_filter(attn_of_alignment_heads, 7) # from whisper.timing
-            attn_of_alignment_heads = attn_of_alignment_heads.mean(dim=1)
-#            logger.debug(str(attn_of_alignment_heads.shape) + " po mean")
-            attn_of_alignment_heads = attn_of_alignment_heads[:,:, :content_mel_len]
-#            logger.debug(str(attn_of_alignment_heads.shape) + " pak ")
-
-            # for each beam, the most attended frame is:
-            most_attended_frames = torch.argmax(attn_of_alignment_heads[:,-1,:], dim=-1)
-            generation_progress_loop.append(("most_attended_frames",most_attended_frames.clone().tolist()))
-            logger.debug(str(most_attended_frames.tolist()) + " most att frames")
-
-            most_attended_frame = most_attended_frames[0].item()
-
-
-            generation_progress.append(dict(generation_progress_loop))
-            logger.debug("current tokens" + str(current_tokens.shape))
-            if completed:
-            #    # stripping the last token, the eot
-                current_tokens = current_tokens[:, :-1]
-                break
-            
-            # for some rare cases where the attention fails
-            if not is_last and self.last_attend_frame - most_attended_frame > self.cfg.rewind_threshold:
-                # TODO: check this
-                if current_tokens.shape[1] > 1 and current_tokens[0, -2] >= DEC_PAD:
-                    logger.debug("ommit rewinding from special tokens")
-                    self.last_attend_frame = most_attended_frame
-                else:
-                    logger.debug(
-                        f"[rewind detected] current attention pos: {most_attended_frame}, "
-                        f"last attention pos: {self.last_attend_frame}; omit this segment")
-                    self.last_attend_frame = -self.cfg.rewind_threshold
-                    current_tokens = torch.cat(self.tokens, dim=1) if len(self.tokens) > 0 else self.tokens[0]
-                    break
-            else:
-                self.last_attend_frame = most_attended_frame
+            self.debug_print_tokens(state, current_tokens)
+
+        # Anti-hallucination: Check for repetition in newly generated tokens
+        new_tokens_so_far = current_tokens[0, job.token_len_before_decoding:].tolist()
+        if detect_repetition(new_tokens_so_far, self.cfg.max_repeat_tokens, self.cfg.max_repeat_ngram):
+            logger.warning("Hallucination detected (repetition), stopping generation")
+            # Remove repeated tokens - keep only first occurrence
+            job.current_tokens = current_tokens[:, :job.token_len_before_decoding]
+            generation["hallucination_detected"] = "repetition"
+            return
+        
+        # Anti-hallucination: Check max tokens per segment
+        if hasattr(self.cfg, 'max_tokens_per_segment') and self.cfg.max_tokens_per_segment > 0:
+            if len(new_tokens_so_far) >= self.cfg.max_tokens_per_segment:
+                logger.warning(f"Max tokens per segment ({self.cfg.max_tokens_per_segment}) reached, stopping")
+                generation["hallucination_detected"] = "max_tokens"
+                return
 
-            if content_mel_len - most_attended_frame <= (4 if is_last else self.cfg.frame_threshold):
-                logger.debug(f"attention reaches the end: {most_attended_frame}/{content_mel_len}")
-                # stripping the last token, the one that is attended too close to the end
-                current_tokens = current_tokens[:, :-1]
-                break
+
+        # if self.decoder_type == "beam":
+        #     logger.debug(f"Finished sequences: {self.token_decoder.finished_sequences}")
+
+        #     logprobs = F.log_softmax(logits.float(), dim=-1)
+        #     idx = 0
+        #     logger.debug(f"Beam search topk: {logprobs[idx].topk(self.cfg.beam_size + 1)}")
+        #     logger.debug(f"Greedy search argmax: {logits.argmax(dim=-1)}")
+        # if completed:
+        #     self.debug_print_tokens(state, current_tokens)
+
+        #     logger.debug("decode stopped because decoder completed")
+
+        # for each beam, the most attended frame is:
+        # the frames are needed at all telemetry levels, for the word timestamps
+        most_attended_frames = job.alignment.most_attended_frames(content_mel_len).tolist()
+        generation_progress_loop.append(("most_attended_frames",most_attended_frames))
+        logger.debug("%s most att frames", most_attended_frames)
+
+        most_attended_frame = most_attended_frames[0]
+
+
+        generation["progress"].append(dict(generation_progress_loop))
+        logger.debug("current tokens %s", current_tokens.shape)
+        if completed:
+        #    # stripping the last token, the eot
+            job.current_tokens = current_tokens[:, :-1]
+            return
         
-            # debug print
-            for i in range(self.cfg.beam_size):
-                logger.debug("attn: {}, current pos: {}, current token: {}({})".format(
-                    attn_of_alignment_heads.shape if attn_of_alignment_heads is not None else None,
-                    most_attended_frames[i], 
-                    current_tokens[i, -1].item(),
-                    self.tokenizer.decode([current_tokens[i, -1].item()])
-                ))
+        # for some rare cases where the attention fails
+        if not job.is_last and state.last_attend_frame - most_attended_frame > self.cfg.rewind_threshold:
+            # TODO: check this
+            if current_tokens.shape[1] > 1 and current_tokens[0, -2] >= DEC_PAD:
+                logger.debug("ommit rewinding from special tokens")
+                state.last_attend_frame = most_attended_frame
+            else:
+                logger.debug(
+                    f"[rewind detected] current attention pos: {most_attended_frame}, "
+                    f"last attention pos: {state.last_attend_frame}; omit this segment")
+                state.last_attend_frame = -self.cfg.rewind_threshold
+                job.current_tokens = torch.cat(state.tokens, dim=1) if len(state.tokens) > 0 else state.tokens[0]
+                return
+        else:
+            state.last_attend_frame = most_attended_frame
+
+        if content_mel_len - most_attended_frame <= (4 if job.is_last else self.cfg.frame_threshold):
+            logger.debug(f"attention reaches the end: {most_attended_frame}/{content_mel_len}")
+            # stripping the last token, the one that is attended too close to the end
+            job.current_tokens = current_tokens[:, :-1]
+            return
+    
+        # debug print
+        for i in range(self.cfg.beam_size if debug else 0):
+            logger.debug("attn tokens: {}, current pos: {}, current token: {}({})".format(
+                job.alignment.n_tokens[0],
+                most_attended_frames[i], 
+                current_tokens[i, -1].item(),
+                state.tokenizer.decode([current_tokens[i, -1].item()])
+            ))
+
+        job.done = not (not completed and current_tokens.shape[1] < self.max_text_len)
+
+    def _finish_job(self, job: DecodingJob):
+        '''The part of the generation after the decoding loop. Returns the new hypothesis and the generation info.'''
+        state = job.state
+        generation = job.generation
+        current_tokens = job.current_tokens
+        token_len_before_decoding = job.token_len_before_decoding
 
 #        for k,v in generation.items():
 #            print(k,v,file=sys.stderr)
@@ -638,20 +754,20 @@ class PaddedAlignAttWhisper:
         #         logger.debug("no token generated")
         #     else:  # it is, and the max attention is:
         #         new_token_max_attn, _ = new_token_attn.max(dim=-1)
-        #         logger.debug(f"segment max attention: {new_token_max_attn.mean().item()/len(self.segments)}")
+        #         logger.debug(f"segment max attention: {new_token_max_attn.mean().item()/len(state.segments)}")
 
 
         # let's now operate only with the top beam hypothesis
         tokens_to_split = current_tokens[0, token_len_before_decoding:]
-        if fire_detected or is_last:
+        if job.fire_detected or job.is_last:
             new_hypothesis = tokens_to_split.flatten().tolist()
         else:
             # going to truncate the tokens after the last space
-            split_words, split_tokens = self.tokenizer.split_to_word_tokens(tokens_to_split.tolist())
+            split_words, split_tokens = state.tokenizer.split_to_word_tokens(tokens_to_split.tolist())
             generation["result"] = {"split_words": split_words[:-1], "split_tokens": split_tokens[:-1]}
             generation["result_truncated"] = {"split_words": split_words[-1:], "split_tokens": split_tokens[-1:]}
 
-#            text_to_split = self.tokenizer.decode(tokens_to_split)
+#            text_to_split = state.tokenizer.decode(tokens_to_split)
 #            logger.debug(f"text_to_split: {text_to_split}")
 #            logger.debug("text at current step: {}".format(text_to_split.replace(" ", "<space>")))
 #            text_before_space = " ".join(text_to_split.split(" ")[:-1])
@@ -666,7 +782,7 @@ class PaddedAlignAttWhisper:
         logger.debug(f"new_hypothesis: {new_hypothesis}")
         
         # Anti-hallucination: Check compression ratio of output text
-        output_text = self.tokenizer.decode(new_hypothesis)
+        output_text = state.tokenizer.decode(new_hypothesis)
         if self.cfg.compression_ratio_threshold > 0 and len(output_text) > 10:
             compression_ratio = calculate_compression_ratio(output_text)
             logger.debug(f"Compression ratio: {compression_ratio:.2f}")
@@ -678,7 +794,7 @@ class PaddedAlignAttWhisper:
         
         # Anti-hallucination: Check average logprob
         if self.cfg.logprob_threshold > -10 and len(new_hypothesis) > 0:
-            avg_logprob = sum_logprobs[0].item() / max(len(new_hypothesis), 1)
+            avg_logprob = job.sum_logprobs[0].item() / max(len(new_hypothesis), 1)
             logger.debug(f"Average logprob: {avg_logprob:.2f}")
             if avg_logprob < self.cfg.logprob_threshold:
                 logger.warning(f"Hallucination detected (avg logprob {avg_logprob:.2f} < {self.cfg.logprob_threshold}), discarding output")
@@ -689,57 +805,27 @@ class PaddedAlignAttWhisper:
         new_tokens = torch.tensor([new_hypothesis], dtype=torch.long).repeat_interleave(self.cfg.beam_size, dim=0).to(
             device=self.model.device,
         )
-        self.tokens.append(new_tokens)
+        state.tokens.append(new_tokens)
+        state.language_tracker.report(generation)
         # TODO: test if this is redundant or not
 #        ret = ret[ret<DEC_PAD]
 
         logger.info(f"Output: {output_text}")
-        
-        self._clean_cache()
-
-        self.logdir_save(input_segments, new_hypothesis, generation)
         return new_hypothesis, generation
 
-    def logdir_save(self, input_segments, new_hypothesis, generation):
-        """The audio and result from each iteration is saved to the logdir for debugging purposes"""
+    def logdir_save(self, state, input_segments, new_hypothesis, generation, is_last=False):
+        """The audio and result from each iteration is saved to the logdir for debugging purposes.
+        It is written by a background thread, see LogdirRecorder."""
 
         # only when the logdir arg is set
-        if self.cfg.logdir is None:
+        if self.logdir_recorder is None:
             return
 
         self.logdir_i += 1
-
-        # every VAD segment is in a separate directory
-        dir = os.path.join(self.cfg.logdir, f"seg_{self.log_segments:05d}")
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-
-        logger.debug(f"Saving to {dir}, iteration {self.logdir_i:05d}")
-
-        # saving wav:
-        wav_path = os.path.join(dir, f"iter_{self.logdir_i:05d}_audio.wav")
-        audio_np = np.array(input_segments)
-        # Ensure audio is float32 in range [-1, 1], convert to int16 for wav
-        if audio_np.dtype != np.int16:
-            audio_int16 = np.clip(audio_np * 32767, -32768, 32767).astype(np.int16)
-        else:
-            audio_int16 = audio_np
-
-        with wave.open(wav_path, "wb") as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)  # 2 bytes for int16
-            wf.setframerate(16000)
-            wf.writeframes(audio_int16.tobytes())
-
-        # saving readable text: context + hypothesis
-        text = self.tokenizer.decode(new_hypothesis)
-        with open(os.path.join(dir, f"iter_{self.logdir_i:05d}_hypothesis.txt"), "w") as f:
-            if generation:
-                context = generation["starting_tokens"].as_text(self.tokenizer)
-            else:
-                context = ""
-            print("CONTEXT+FORCED:",context,sep="\t",file=f)
-            print("HYPOTHESIS:", text, sep="\t", file=f)
-
-        # TODO: generation progress can be also saved in a readable format
-        #logger.debug(f"generation progress: {generation}")
\ No newline at end of file
+        logger.debug(f"Saving to segment {state.log_segment:05d}, iteration {self.logdir_i:05d}")
+        if not torch.is_tensor(input_segments):
+            input_segments = torch.as_tensor(np.asarray(input_segments, dtype=np.float32))
+        # the session, the segmentation of the buffer and is_last make the iteration replayable, see replay_logdir.py
+        self.logdir_recorder.record(state.log_segment, self.logdir_i, state.tokenizer, input_segments, state.audio_end,
+                                    new_hypothesis, generation, session=state.session_id,
+                                    segments=[s.shape[0] for s in state.segments], is_last=is_last)
@@ -82,6 +82,8 @@ class MultiHeadAttention(nn.Module):
         self.value.cache_id = f"{cache_id}_value"
         self.out = nn.Linear(n_state, n_state)
         self.cache_id = cache_id
+        # heads whose attention logits are returned, all if None. Set by PaddedAlignAttWhisper to the alignment heads.
+        self.qk_heads = None
 
     def forward(
         self,
@@ -138,12 +140,19 @@ class MultiHeadAttention(nn.Module):
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
-        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
+        # use_sdpa can be overridden per instance
+        if SDPA_AVAILABLE and self.use_sdpa:
             a = scaled_dot_product_attention(
                 q, k, v, is_causal=mask is not None and n_ctx > 1
             )
             out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = None
+            if self.qk_heads is not None:
+                # the attention logits only for the selected heads
+                qk = (q[:, self.qk_heads] * scale) @ (k[:, self.qk_heads] * scale).transpose(-1, -2)
+                if mask is not None:
+                    qk = qk + mask[:n_ctx, :n_ctx]
+                qk = qk.float().detach()
         else:
             qk = (q * scale) @ (k * scale).transpose(-1, -2)
             if mask is not None:
@@ -153,6 +162,8 @@ class MultiHeadAttention(nn.Module):
             w = F.softmax(qk, dim=-1).to(q.dtype)
             out = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = qk.detach()
+            if self.qk_heads is not None:
+                qk = qk[:, self.qk_heads]
 
         return out, qk
 
@@ -255,15 +266,21 @@ class TextDecoder(nn.Module):
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None, logit_positions: Optional[list] = None):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        logit_positions : list of int, optional
+            the token positions to compute the logits for, all if None
         """
 
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+        if hasattr(kv_cache, "offset"):
+            # StaticKVCache knows the length of the self-attention cache
+            offset = kv_cache.offset
+        else:
+            offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
         x = (
             self.token_embedding(x)
             + self.positional_embedding[offset : offset + x.shape[-1]]
@@ -276,6 +293,8 @@ class TextDecoder(nn.Module):
             x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
             i += 1
 
+        if logit_positions is not None:
+            x = x[:, logit_positions]
         x = self.ln(x)
         logits = x @ torch.transpose(self.token_embedding.weight, 0, 1)
 
@@ -283,29 +283,24 @@ class Tokenizer:
 
         return self.split_tokens_on_spaces(tokens)
 
-    def split_tokens_on_unicode(self, tokens: List[int]):
-        decoded_full = self.decode_with_timestamps(tokens)
-        replacement_char = "\ufffd"
-
-        words = []
-        word_tokens = []
-        current_tokens = []
-        unicode_offset = 0
+    @cached_property
+    def token_bytes(self) -> List[bytes]:
+        """The bytes of every token id, the special tokens included"""
+        return get_token_bytes(self.encoding)
 
-        for token in tokens:
-            current_tokens.append(token)
-            decoded = self.decode_with_timestamps(current_tokens)
-
-            if (
-                replacement_char not in decoded
-                or decoded_full[unicode_offset + decoded.index(replacement_char)]
-                == replacement_char
-            ):
-                words.append(decoded)
-                word_tokens.append(current_tokens)
-                current_tokens = []
-                unicode_offset += len(decoded)
+    def ends_with_incomplete_unicode(self, tokens: List[int]) -> bool:
+        """Whether the last tokens end in the middle of a UTF-8 encoded character"""
+        splitter = UnicodeSplitter(self)
+        splitter.append(tokens)
+        return len(splitter.pending) > 0
 
+    def split_tokens_on_unicode(self, tokens: List[int]):
+        splitter = UnicodeSplitter(self)
+        words, word_tokens = splitter.append(tokens)
+        last_word, last_tokens = splitter.flush()
+        if last_tokens:
+            words.append(last_word)
+            word_tokens.append(last_tokens)
         return words, word_tokens
 
     def split_tokens_on_spaces(self, tokens: List[int]):
@@ -327,6 +322,82 @@ class Tokenizer:
         return words, word_tokens
 
 
+class UnicodeSplitter:
+    """Splits a stream of tokens to the groups that decode to complete unicode characters, as
+    Tokenizer.split_tokens_on_unicode, in one pass over the token bytes.
+
+    A token can end in the middle of a multi-byte UTF-8 character, which the next tokens complete. The splitter
+    follows the UTF-8 sequences in the token bytes, and a group ends after a token where no sequence is open.
+    The tokens of an open sequence stay pending until the next append(), or until flush().
+    Invalid bytes end the group as the complete characters do, and they are decoded to the replacement character.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.token_bytes = tokenizer.token_bytes
+        self.pending = []  # the tokens of the incomplete group
+        self.pending_bytes = b""
+        self.missing = 0  # the number of continuation bytes that the open UTF-8 sequence needs
+        self.lower, self.upper = 0x80, 0xBF  # the valid range of the next continuation byte
+        self.sequence_start = 0  # the index of the pending token where the open sequence starts
+
+    def _start(self, byte: int):
+        # the valid lead bytes and the ranges of their second byte, as the UTF-8 decoder of Python checks them
+        if 0xC2 <= byte <= 0xDF:
+            self.missing, self.lower, self.upper = 1, 0x80, 0xBF
+        elif 0xE0 <= byte <= 0xEF:
+            self.missing = 2
+            self.lower, self.upper = (0xA0, 0xBF) if byte == 0xE0 else (0x80, 0x9F) if byte == 0xED else (0x80, 0xBF)
+        elif 0xF0 <= byte <= 0xF4:
+            self.missing = 3
+            self.lower, self.upper = (0x90, 0xBF) if byte == 0xF0 else (0x80, 0x8F) if byte == 0xF4 else (0x80, 0xBF)
+        else:
+            # ASCII, or an invalid byte that is decoded to the replacement character
+            self.missing = 0
+
+    def _cut(self, words, word_tokens):
+        # The open sequence is invalid, so it does not join the tokens that it spans. The group ends at the token
+        # where the sequence starts, and each of the following pending tokens is a group.
+        cut = self.sequence_start + 1
+        for group in [self.pending[:cut]] + [[t] for t in self.pending[cut:]]:
+            words.append(b"".join(self.token_bytes[t] for t in group).decode("utf-8", errors="replace"))
+            word_tokens.append(group)
+        self.pending, self.pending_bytes = [], b""
+
+    def append(self, tokens: List[int]):
+        """Returns the complete groups as the decoded texts and the token lists."""
+        words, word_tokens = [], []
+        for token in tokens:
+            data = self.token_bytes[token]
+            for byte in data:
+                if self.missing > 0 and self.lower <= byte <= self.upper:
+                    self.missing -= 1
+                    self.lower, self.upper = 0x80, 0xBF
+                    continue
+                if self.missing > 0 and self.sequence_start < len(self.pending):
+                    self._cut(words, word_tokens)
+                self._start(byte)
+                self.sequence_start = len(self.pending)
+            self.pending.append(token)
+            self.pending_bytes += data
+            if self.missing == 0:
+                words.append(self.pending_bytes.decode("utf-8", errors="replace"))
+                word_tokens.append(self.pending)
+                self.pending, self.pending_bytes = [], b""
+        return words, word_tokens
+
+    def flush(self):
+        """Returns the pending incomplete group, as the decoded text and the tokens, and empties it."""
+        word = self.pending_bytes.decode("utf-8", errors="replace")
+        tokens = self.pending
+        self.pending, self.pending_bytes, self.missing = [], b"", 0
+        return word, tokens
+
+
+@lru_cache(maxsize=None)
+def get_token_bytes(encoding: tiktoken.Encoding) -> List[bytes]:
+    return [encoding.decode_single_token_bytes(t) for t in range(encoding.n_vocab)]
+
+
 @lru_cache(maxsize=None)
 def get_encoding(name: str = "gpt2", num_languages: int = 99):
     vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
@@ -17,12 +17,20 @@ def simulwhisper_args(parser):
     group.add_argument("--beams","-b", type=int, default=1, help="Number of beams for beam search decoding. If 1, GreedyDecoder is used.")
     group.add_argument("--decoder",type=str, default=None, help="Override automatic selection of beam or greedy decoder. "
                         "If beams > 1 and greedy: invalid.")
+    group.add_argument("--telemetry", type=str, default="standard", choices=["minimal", "standard", "full"],
+                        help="What is kept from every decoding step. minimal: only the most attended frames that the word timestamps need. "
+                        "standard: also the tokens and scores of every step, and the prompt for --logdir. full: also the logits, for debugging.")
 
     group = parser.add_argument_group('Audio buffer')
     group.add_argument('--audio_max_len', type=float, default=5.0, 
                         help='Max length of the audio buffer, in seconds.')
     group.add_argument('--audio_min_len', type=float, default=0.0, 
                         help='Skip processing if the audio buffer is shorter than this length, in seconds. Useful when the --min-chunk-size is small.')
+    group.add_argument('--short_context', action="store_true", default=False,
+                        help='Encode only the audio buffer plus a short margin, instead of the buffer padded to 30 seconds. '
+                        'It is faster, especially on CPU, but it may decrease quality. Use compare_encoder_context.py to compare it on your data.')
+    group.add_argument('--short_context_margin', type=int, default=50,
+                        help='The number of zero-padding encoder frames after the audio in the --short_context mode. One frame is 0.02 seconds.')
 
 
     group = parser.add_argument_group('AlignAtt argument')
@@ -30,6 +38,36 @@ def simulwhisper_args(parser):
                         help='Threshold for the attention-guided decoding. The AlignAtt policy will decode only ' \
                             'until this number of frames from the end of audio. In frames: one frame is 0.02 seconds for large-v3 model. ')
 
+    group.add_argument('--decoder_frames_margin', type=int, default=None,
+                        help='If set, the decoder cross-attends only to the encoder frames of the audio buffer and this number of following frames, '
+                        'instead of all 1500 frames. It makes decoding faster. One frame is 0.02 seconds. By default, all frames are used.')
+    group.add_argument("--sdpa", action=argparse.BooleanOptionalAction, default=True,
+                       help="Use the fused scaled_dot_product_attention of PyTorch in the encoder and in the decoder. The attention weights "
+                       "are computed explicitly only for the alignment heads that AlignAtt needs. --no-sdpa computes all attention explicitly.")
+
+    group = parser.add_argument_group('Batching of concurrent streams (server with --max-clients > 1)')
+    group.add_argument('--encoder_batch_size', type=int, default=1,
+                        help='Max number of concurrent streams whose audio is encoded in one batch, in a worker thread outside of the model lock. '
+                        '1: no batching, the encoder runs under the model lock, serialized with the other streams.')
+    group.add_argument('--encoder_batch_wait', type=float, default=0.01,
+                        help='Max time in seconds that the encoder waits for the inputs of other streams to the batch.')
+    group.add_argument('--decode_batch_size', type=int, default=1,
+                        help='Max number of concurrent streams whose decoding steps run in one batch, joining and leaving '
+                        'the batch independently. 1: no batching.')
+
+    group = parser.add_argument_group('Language identification (--lan auto)')
+    group.add_argument('--lan_candidates', type=str, default=None,
+                        help='Comma-separated language codes that the language identification chooses from, e.g. vi,en. By default, all languages.')
+    group.add_argument('--lan_confirm_utterances', type=int, default=2,
+                        help='The language of a stream is detected in every utterance until it is confirmed over at least this number of utterances. '
+                        'Then it is reused without detection.')
+    group.add_argument('--lan_confirm_prob', type=float, default=0.8,
+                        help='Min mean probability of the detected language over the utterances to confirm it, and min probability of another '
+                        'language to replace the confirmed one.')
+    group.add_argument('--lan_recheck_interval', type=int, default=20,
+                        help='The confirmed language is detected again after this number of utterances, and after an utterance whose output '
+                        'was discarded by the compression ratio or logprob check or exceeded --nonspeech_prob. 0: no periodic check.')
+
     group = parser.add_argument_group('Truncation of the last decoded word (from Simul-Whisper)')
     group.add_argument('--cif_ckpt_path', type=str, default=None, 
                         help='The file path to the Simul-Whisper\'s CIF model checkpoint that detects whether there is' \
@@ -81,12 +119,18 @@ def simul_asr_factory(args):
         # else: it is greedy or beam, that's ok 
     
     a = { v:getattr(args, v) for v in ["model_path", "cif_ckpt_path", "frame_threshold", "audio_min_len", "audio_max_len", "beams", "task",
-                                       "never_fire", 'init_prompt', 'static_init_prompt', 'max_context_tokens', "logdir",
+                                       "short_context", "short_context_margin", "decoder_frames_margin", "sdpa",
+                                       "encoder_batch_size", "encoder_batch_wait", "decode_batch_size",
+                                       "never_fire", 'init_prompt', 'static_init_prompt', 'max_context_tokens', "logdir", "telemetry",
                                        # Anti-hallucination settings
                                        "nonspeech_prob", "max_repeat_tokens", "max_repeat_ngram", 
                                        "compression_ratio_threshold", "logprob_threshold", "max_tokens_per_segment"
                                        ]}
     a["language"] = args.lan
+    a["language_candidates"] = args.lan_candidates
+    a["language_confirm_utterances"] = args.lan_confirm_utterances
+    a["language_confirm_prob"] = args.lan_confirm_prob
+    a["language_recheck_interval"] = args.lan_recheck_interval
     a["segment_length"] = args.min_chunk_size
     a["decoder_type"] = decoder
 
@@ -106,7 +150,11 @@ class SimulWhisperASR(ASRBase):
                  decoder_type, never_fire, init_prompt, static_init_prompt, max_context_tokens, logdir,
                  # Anti-hallucination settings
                  nonspeech_prob=0.6, max_repeat_tokens=3, max_repeat_ngram=4,
-                 compression_ratio_threshold=2.4, logprob_threshold=-1.0, max_tokens_per_segment=100):
+                 compression_ratio_threshold=2.4, logprob_threshold=-1.0, max_tokens_per_segment=100,
+                 short_context=False, short_context_margin=50, decoder_frames_margin=None, sdpa=True,
+                 encoder_batch_size=1, encoder_batch_wait=0.01, decode_batch_size=1,
+                 language_candidates=None, language_confirm_utterances=2, language_confirm_prob=0.8, language_recheck_interval=20,
+                 telemetry="standard"):
         cfg = AlignAttConfig(
             model_path=model_path, 
             segment_length=segment_length,
@@ -114,6 +162,17 @@ class SimulWhisperASR(ASRBase):
             language=language,
             audio_max_len=audio_max_len, 
             audio_min_len=audio_min_len,
+            short_context=short_context,
+            short_context_margin=short_context_margin,
+            decoder_frames_margin=decoder_frames_margin,
+            sdpa=sdpa,
+            encoder_batch_size=encoder_batch_size,
+            encoder_batch_wait=encoder_batch_wait,
+            decode_batch_size=decode_batch_size,
+            language_candidates=language_candidates,
+            language_confirm_utterances=language_confirm_utterances,
+            language_confirm_prob=language_confirm_prob,
+            language_recheck_interval=language_recheck_interval,
             cif_ckpt_path=cif_ckpt_path,
             decoder_type=decoder_type, #"greedy" if beams==1 else "beam",
             beam_size=beams,
@@ -123,6 +182,7 @@ class SimulWhisperASR(ASRBase):
             max_context_tokens=max_context_tokens,
             static_init_prompt=static_init_prompt,
             logdir=logdir,
+            telemetry=telemetry,
             # Anti-hallucination settings
             nonspeech_prob=nonspeech_prob,
             max_repeat_tokens=max_repeat_tokens,
@@ -156,6 +216,8 @@ class SimulWhisperOnline(OnlineProcessorInterface):
 
     def __init__(self, asr):
         self.model = asr.model
+        # the state of this stream. The model can be shared by many streams.
+        self.state = self.model.new_session()
         self.file = None
         self.init()
 
@@ -171,7 +233,7 @@ class SimulWhisperOnline(OnlineProcessorInterface):
 
         self.audio_bufer_offset = self.offset
         self.last_ts = -1
-        self.model.refresh_segment(complete=True)
+        self.model.refresh_segment(complete=True, state=self.state)
 
         self.unicode_buffer = []  # hide incomplete unicode character for the next iteration
 
@@ -184,7 +246,7 @@ class SimulWhisperOnline(OnlineProcessorInterface):
 
         pr = generation["progress"]
         if "result" not in generation or self.unicode_buffer != []:
-            split_words, split_tokens = self.model.tokenizer.split_to_word_tokens(tokens)
+            split_words, split_tokens = self.state.tokenizer.split_to_word_tokens(tokens)
         else:
             split_words, split_tokens = generation["result"]["split_words"], generation["result"]["split_tokens"]
 
@@ -230,8 +292,7 @@ class SimulWhisperOnline(OnlineProcessorInterface):
             logger.debug(f"Hiding incomplete unicode character: {self.unicode_buffer}")
             tokens = self.unicode_buffer + tokens
             self.unicode_buffer = []  # clear the buffer after processing
-        chars, _ = self.model.tokenizer.split_tokens_on_unicode(tokens)
-        if len(chars) > 0 and chars[-1].endswith('�'):
+        if self.state.tokenizer.ends_with_incomplete_unicode(tokens):
             self.unicode_buffer = tokens[-1:]  # keep the last incomplete unicode character
             logger.debug(f"Hiding incomplete unicode character: {tokens[-1:]}")
             return tokens[:-1]  # remove the last token, which is incomplete unicode character
@@ -247,12 +308,12 @@ class SimulWhisperOnline(OnlineProcessorInterface):
             else:
                 self.end += audio.shape[0] / self.SAMPLING_RATE
         self.audio_chunks = []
-        self.audio_bufer_offset += self.model.insert_audio(audio)
-        tokens, generation_progress = self.model.infer(is_last=self.is_last)
+        self.audio_bufer_offset += self.model.insert_audio(audio, state=self.state)
+        tokens, generation_progress = self.model.infer(is_last=self.is_last, state=self.state)
 
         tokens = self.hide_incomplete_unicode(tokens)
 
-        text = self.model.tokenizer.decode(tokens)
+        text = self.state.tokenizer.decode(tokens)
         if len(text) == 0:
             return {}
         
@@ -283,11 +344,11 @@ class SimulWhisperOnline(OnlineProcessorInterface):
         self.is_last = True
         o = self.process_iter()
         self.is_last = False
-        self.model.refresh_segment(complete=True)
+        self.model.refresh_segment(complete=True, state=self.state)
         return o
     
 
 if __name__ == "__main__":
 
     from whisper_streaming.whisper_online_main import main_simulation_from_file
-    main_simulation_from_file(simul_asr_factory, add_args=simulwhisper_args)
\ No newline at end of file
+    main_simulation_from_file(simul_asr_factory, add_args=simulwhisper_args, stream_factory=SimulWhisperOnline)
\ No newline at end of file
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Runs a grid of parameter configurations over a directory of audio files in the computationally unaware
+# simulation, in parallel worker processes, and prints a table of the quality, the latency and the compute cost
+# of every configuration.
+#
+# The reference transcript of audio.wav is read from audio.txt, if it exists. The metrics of a configuration:
+#   WER: word error rate of the concatenated output against the reference, over all files with a reference
+#   AL: average lagging in seconds, how much the output words lag behind an ideal real-time transcriber
+#   latency: mean of the emission time minus the end timestamp of the emitted words, in seconds
+#   RTF: the processing time divided by the audio duration
+#
+# The audio is decoded once in the main process and the worker processes are forked, so they share it.
+# Every worker loads the model for every configuration again, because the configurations can change it.
+#
+# Example:
+#   python3 sweep.py corpus_dir --model_path large-v3.pt --lan cs -l WARNING --workers 8 --threads 4 \
+#       --grid frame_threshold=15,25 audio_max_len=5,10 min_chunk_size=0.5,1.0
+
+import os
+import sys
+import json
+import copy
+import logging
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from whisper_streaming.whisper_online_main import processor_args, set_logging, load_audio, asr_factory
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from compare_encoder_context import word_error_rate
+from benchmark import audio_files, run_file
+
+logger = logging.getLogger(__name__)
+
+# set in the main process before the workers are forked
+BASE_ARGS = None
+FILES = None
+REFERENCES = None
+
+
+def parse_grid(parser, grid):
+    '''Parses "name=v1,v2" items to a dict of the argument dest -> list of the values converted by the parser.'''
+    actions = {a.dest: a for a in parser._actions}
+    result = {}
+    for item in grid:
+        name, _, values = item.partition("=")
+        dest = name.lstrip("-").replace("-", "_")
+        if dest not in actions or not values:
+            parser.error(f"Invalid grid item: {item}")
+        action = actions[dest]
+        convert = action.type or (lambda v: v.lower() in ("1", "true", "yes")
+                                  if isinstance(action.default, bool) else v)
+        result[dest] = [convert(v) for v in values.split(",")]
+    return result
+
+
+def average_lagging(emissions, duration, n_reference):
+    '''Average lagging of the emission times of the output words (in seconds of the processed audio), against an
+    ideal policy that emits the reference words evenly over the audio. It is computed up to the first word
+    emitted after the whole audio was read.'''
+    if not emissions:
+        return None
+    rate = duration / max(n_reference or len(emissions), 1)
+    lags = []
+    for i, d in enumerate(emissions):
+        lags.append(d - i * rate)
+        if d >= duration:
+            break
+    return sum(lags) / len(lags)
+
+
+def run_config(overrides):
+    args = copy.copy(BASE_ARGS)
+    for k, v in overrides.items():
+        setattr(args, k, v)
+    logging.getLogger("simul_whisper").setLevel(args.log_level)
+    asr, online = asr_factory(args, simul_asr_factory)
+    min_chunk = args.vac_chunk_size if args.vac else args.min_chunk_size
+
+    wer_errors = wer_words = 0.0
+    lags, latencies = [], []
+    total_duration = total_time = 0.0
+    n_iter = 0
+    for path in FILES:
+        duration, words, times = run_file(online, path, min_chunk, comp_unaware=True)
+        total_duration += duration
+        total_time += sum(times)
+        n_iter += len(times)
+        latencies += [emitted - end for emitted, end, _ in words]
+        reference = REFERENCES.get(path)
+        al = average_lagging([emitted for emitted, _, _ in words], duration,
+                             len(reference.split()) if reference else None)
+        if al is not None:
+            lags.append(al)
+        if reference is not None:
+            hypothesis = "".join(text for _, _, text in words)
+            n = len(reference.split())
+            wer_errors += word_error_rate(reference, hypothesis) * n
+            wer_words += n
+    return {
+        "config": overrides,
+        "wer": wer_errors / wer_words if wer_words else None,
+        "al": sum(lags) / len(lags) if lags else None,
+        "latency": sum(latencies) / len(latencies) if latencies else None,
+        "rtf": total_time / total_duration if total_duration else None,
+        "ms_per_iteration": total_time / n_iter * 1000 if n_iter else None,
+    }
+
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def main():
+    global BASE_ARGS, FILES, REFERENCES
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument('audio_dir', type=str, help="Directory with 16kHz mono audio files and their .txt references.")
+    parser.add_argument('--grid', type=str, nargs="+", required=True,
+                        help="Parameter values to combine, e.g. frame_threshold=15,25 audio_max_len=5,10. "
+                        "Any argument of simulstreaming_whisper.py can be used, by its name with underscores.")
+    parser.add_argument('--workers', type=int, default=max(os.cpu_count() // 4, 1), help="Number of worker processes.")
+    parser.add_argument('--threads', type=int, default=4, help="Number of torch threads of every worker.")
+    parser.add_argument('--output', type=str, default=None, help="Save the results to this JSON file.")
+    args = parser.parse_args()
+    set_logging(args, logger)
+    grid = parse_grid(parser, args.grid)
+
+    FILES = audio_files(args.audio_dir)
+    if not FILES:
+        logger.error(f"No audio files in {args.audio_dir}.")
+        sys.exit(1)
+    REFERENCES = {}
+    for path in FILES:
+        load_audio(path)  # into the cache that the forked workers share
+        ref = os.path.splitext(path)[0] + ".txt"
+        if os.path.exists(ref):
+            with open(ref) as f:
+                REFERENCES[path] = f.read().strip()
+    BASE_ARGS = args
+    args.logdir = None
+
+    configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    logger.info(f"{len(configs)} configurations, {len(FILES)} files, {len(REFERENCES)} references")
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(args.workers, mp_context=context, initializer=init_worker,
+                             initargs=(args.threads,)) as pool:
+        results = list(pool.map(run_config, configs))
+
+    fmt = lambda x, f: "-" if x is None else f.format(x)
+    keys = list(grid)
+    print("\t".join(keys + ["WER", "AL", "latency", "RTF", "ms/iter"]))
+    for r in sorted(results, key=lambda r: (r["wer"] is None, r["wer"], r["al"] is None, r["al"])):
+        print("\t".join([str(r["config"][k]) for k in keys] + [
+            fmt(r["wer"] and r["wer"] * 100, "{:.2f}"), fmt(r["al"], "{:.3f}"), fmt(r["latency"], "{:.3f}"),
+            fmt(r["rtf"], "{:.3f}"), fmt(r["ms_per_iteration"], "{:.1f}")]), flush=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from simul_whisper.alignment import AlignmentTracker
+from simul_whisper.whisper.timing import median_filter
+
+ALIGN_SOURCE = {1: [(0, 2), (1, 5)], 3: [(2, 0)]}  # layer rank -> (alignment head rank, head id)
+N_LAYERS, N_HEAD, N_FRAMES, CONTENT_MEL_LEN = 4, 6, 300, 250
+TOLERANCE = 1e-5  # of the normalized and filtered attention, when the argmax differs between near-equal frames
+
+
+def reference_attention(layer_qks):
+    '''The previous implementation: the attention of all the tokens is stacked per alignment head, normalized over
+    the tokens, median filtered, and averaged over the heads. Returns the attention of the last token.'''
+    heads = [[] for _ in range(3)]
+    for layer_rank, qk in layer_qks:
+        for align_head_rank, head_id in ALIGN_SOURCE.get(layer_rank, []):
+            heads[align_head_rank].append(F.softmax(qk[:, head_id], dim=-1))
+    a = torch.stack([torch.cat(h, dim=1) for h in heads], dim=1)
+    std, mean = torch.std_mean(a, dim=-2, keepdim=True, unbiased=False)
+    a = median_filter((a - mean) / std, 7).mean(dim=1)[:, :, :CONTENT_MEL_LEN]
+    return a[:, -1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("batch", [1, 3])
+def test_most_attended_frames_equal_the_full_history(seed, batch):
+    generator = torch.Generator().manual_seed(seed)
+    tracker = AlignmentTracker(ALIGN_SOURCE, num_align_heads=3)
+    layer_qks = []
+    for step in range(30):
+        n_tokens = 8 if step == 0 else 1  # the prompt is decoded in the first step
+        for layer_rank in range(N_LAYERS):
+            qk = 4 * torch.randn(batch, N_HEAD, n_tokens, N_FRAMES, generator=generator)
+            tracker.update(layer_rank, qk)
+            layer_qks.append((layer_rank, qk))
+
+        frames = tracker.most_attended_frames(CONTENT_MEL_LEN)
+        attention = reference_attention(layer_qks)
+        expected = attention.argmax(dim=-1)
+        for b in range(batch):
+            if frames[b] != expected[b]:
+                assert attention[b, expected[b]] - attention[b, frames[b]] < TOLERANCE
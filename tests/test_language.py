@@ -0,0 +1,25 @@
+from simul_whisper.language import LanguageTracker
+
+
+def vac_utterance(tracker, generation={}):
+    # VAC refreshes the segment at the start and at the end of every utterance
+    tracker.next_utterance()
+    tracker.report(generation)
+    tracker.next_utterance()
+
+
+def test_recheck_counts_one_utterance_per_vac_utterance():
+    tracker = LanguageTracker(confirm_utterances=1, confirm_prob=0.8, recheck_interval=3)
+    tracker.observe({"en": 0.9, "cs": 0.1})
+    for _ in range(2):
+        vac_utterance(tracker)
+        assert not tracker.needs_detection()
+    vac_utterance(tracker)
+    assert tracker.needs_detection()
+
+
+def test_no_speech_marks_the_language_for_a_check():
+    tracker = LanguageTracker(confirm_utterances=1, confirm_prob=0.8, recheck_interval=0)
+    tracker.observe({"en": 0.9, "cs": 0.1})
+    vac_utterance(tracker, {"no_speech": True})
+    assert tracker.needs_detection()
@@ -0,0 +1,74 @@
+import json
+import socket
+import threading
+
+import numpy as np
+
+from whisper_streaming import frame_protocol
+from whisper_streaming.whisper_server import Connection, FramedServerProcessor
+
+
+class RecordingOnline:
+    '''An online processor that records the audio of every iteration, copied when it is processed.'''
+
+    def __init__(self):
+        self.chunks = []
+        self.processed = []
+
+    def init(self, offset=None):
+        self.chunks = []
+
+    def insert_audio_chunk(self, audio):
+        self.chunks.append(audio)  # a view of the ring, as SimulWhisperOnline keeps it
+
+    def process_iter(self):
+        if self.chunks:
+            self.processed.append(np.concatenate(self.chunks))
+        self.chunks = []
+        return {}
+
+    def finish(self):
+        return self.process_iter()
+
+
+def receive_control(reader):
+    frame_type, payload = reader.receive_frame()
+    assert frame_type == frame_protocol.CONTROL
+    return json.loads(payload)
+
+
+def test_audio_before_config_is_processed_before_it_is_overwritten():
+    server, client = socket.socketpair()
+    online = RecordingOnline()
+    connection = Connection(server)
+    proc = None
+
+    def serve():
+        nonlocal proc
+        assert connection.detect_protocol()
+        proc = FramedServerProcessor(connection, online, min_chunk=1.0)
+        proc.process()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    reader = frame_protocol.FrameReader(client)
+    client.sendall(frame_protocol.MAGIC)
+    assert receive_control(reader)["type"] == "hello"
+
+    rng = np.random.default_rng(0)
+    first = rng.integers(-32768, 32767, 1000, dtype=np.int16)
+    # the config wakes the inference loop with the first audio pending, shorter than min_chunk
+    client.sendall(frame_protocol.encode_frame(frame_protocol.AUDIO, first.astype("<i2").tobytes()) +
+                   frame_protocol.encode_json(frame_protocol.CONTROL, {"type": "config", "min_chunk_size": 10}))
+    assert receive_control(reader) == {"type": "ack", "request": "config"}
+    # a full ring of audio, which overwrites the first audio if its samples were released unprocessed
+    second = rng.integers(-32768, 32767, proc.max_samples, dtype=np.int16)
+    client.sendall(frame_protocol.encode_frame(frame_protocol.AUDIO, second.astype("<i2").tobytes()) +
+                   frame_protocol.encode_json(frame_protocol.CONTROL, {"type": "finish"}))
+    frame_type, payload = reader.receive_frame()
+    assert frame_type == frame_protocol.RESULT and json.loads(payload)["finished"]
+    client.close()
+    thread.join(10)
+
+    sent = np.concatenate([first, second]).astype(np.float32) / 32768
+    np.testing.assert_array_equal(np.concatenate(online.processed), sent)
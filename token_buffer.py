@@ -1,37 +1,83 @@
+from collections import deque
+
 import torch
-import sys
+
 class TokenBuffer:
+    '''The context (prompt) of the decoder: prefix token ids, static tokens that are never trimmed, and the token
+    ids of the words that are trimmed from the beginning.
+
+    The tokens are kept as ids split to words, so appending the decoded tokens and trimming the words does not
+    encode the text again. The token list and the tensors are cached until the next change.
+    '''
 
-    def __init__(self, text="", tokenizer=None, device=None, prefix_token_ids=[]):
-        self.text = text
+    def __init__(self, text="", tokenizer=None, device=None, prefix_token_ids=[], static_text=""):
         self.prefix_token_ids = prefix_token_ids
         self.tokenizer = tokenizer
         self.device = device
+        self.static_token_ids = self._encode(static_text) if static_text else []
+        self.words = deque()  # token ids of the words that can be trimmed
+        self.n_word_tokens = 0
+        self._cache = {}
+        if text:
+            self.append_text(text)
 
-    def as_token_ids(self, tokenizer=None):
+    def _encode(self, text):
+        if self.tokenizer is None:
+            raise ValueError("Tokenizer is not set.")
+        return self.tokenizer.encode(text)
+
+    def _changed(self):
+        self._cache = {}
 
-        if tokenizer is None:
-            tokenizer = self.tokenizer
-        if tokenizer is None:
-            raise ValueError("Tokenizer is not set.") 
-        return self.prefix_token_ids + tokenizer.encode(self.text)
+    def copy(self):
+        '''Returns a copy that is not affected by the changes of this buffer.'''
+        other = TokenBuffer.__new__(TokenBuffer)
+        other.__dict__.update(self.__dict__)
+        other.words = deque(self.words)
+        other._cache = {}
+        return other
+
+    @property
+    def n_tokens(self):
+        '''The number of tokens without the prefix.'''
+        return len(self.static_token_ids) + self.n_word_tokens
+
+    @property
+    def text(self):
+        return self.as_text()
+
+    def as_token_ids(self, tokenizer=None):
+        if "ids" not in self._cache:
+            ids = self.prefix_token_ids + self.static_token_ids
+            for w in self.words:
+                ids += w
+            self._cache["ids"] = ids
+        return self._cache["ids"]
 
     def as_tensor(self, device=None):
         if device is None:
             device = self.device
         if device is None:
             raise ValueError("Device is not set.")
-        tok_ids = self.as_token_ids()
-        return torch.tensor(tok_ids, 
-                     dtype=torch.long, device=device).unsqueeze(0)
+        key = ("tensor", device)
+        if key not in self._cache:
+            self._cache[key] = torch.tensor(self.as_token_ids(), dtype=torch.long, device=device).unsqueeze(0)
+        return self._cache[key]
 
     def as_tensor_beam(self, beam, device=None):
-        t = self.as_tensor(device=device)
-        return t.repeat_interleave(beam, dim=0)
-
+        if device is None:
+            device = self.device
+        key = ("beam", beam, device)
+        if key not in self._cache:
+            self._cache[key] = self.as_tensor(device=device).repeat_interleave(beam, dim=0)
+        return self._cache[key]
 
     def as_text(self):
-        return self.text
+        if self.tokenizer is None:
+            raise ValueError("Tokenizer is not set.")
+        if "text" not in self._cache:
+            self._cache["text"] = self.tokenizer.decode(self.as_token_ids()[len(self.prefix_token_ids):])
+        return self._cache["text"]
 
     @staticmethod
     def empty(*a, **kw):
@@ -40,34 +86,49 @@ class TokenBuffer:
     @staticmethod
     def from_text(text, *a, **kw):
         return TokenBuffer(*a, text=text, **kw)
-    
+
     def is_empty(self):
-        return self.text is None or self.text == ""
+        return self.n_tokens == 0
 
-    def trim_words(self, num=1, after=0):
+    def trim_words(self, num=1):
         '''
-        num: how many words to trim from the beginning
-        after: how many characters to skip (length of the static prompt)
+        num: how many words to trim from the beginning. The static tokens are not trimmed.
+        Returns the number of trimmed tokens.
         '''
-        tokenizer = self.tokenizer
-        assert tokenizer is not None, "Tokenizer is not set."
-
-        ids = tokenizer.encode(self.text[after:])
-        words, wids = self.tokenizer.split_to_word_tokens(ids)
-#        print(words, file=sys.stderr)
-#        print(wids, file=sys.stderr)
-        if not words:
-            return 0
-        self.text = self.text[:after] + "".join(words[num:])
-        return sum(len(wi) for wi in wids[:num])
+        trimmed = 0
+        for _ in range(min(num, len(self.words))):
+            trimmed += len(self.words.popleft())
+        self.n_word_tokens -= trimmed
+        if trimmed:
+            self._changed()
+        return trimmed
 
     def append_token_ids(self, token_ids):
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
-        self.text += self.tokenizer.decode(token_ids)
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        if not token_ids:
+            return
+        if self.words:
+            # The new tokens are split together with the last word, so they continue it exactly as if the whole
+            # sequence was split at once: by the rule of every subword in split_tokens_on_spaces, and with a
+            # character whose UTF-8 bytes are split between the appends kept in one word. The first word of the
+            # result starts with the last word.
+            last = self.words.pop()
+            self.n_word_tokens -= len(last)
+            token_ids = last + token_ids
+        _, word_tokens = tokenizer.split_to_word_tokens(token_ids)
+        for w in word_tokens:
+            self.words.append(list(w))
+            self.n_word_tokens += len(w)
+        self._changed()
+
+    def append_text(self, text):
+        self.append_token_ids(self._encode(text))
 
     def as_split_word_tokens(self):
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
-        ids = tokenizer.encode(self.text)
-        return tokenizer.split_to_word_tokens(ids)
+        word_tokens = [list(w) for w in self.words]
+        return [tokenizer.decode(w) for w in word_tokens], word_tokens
@@ -4,12 +4,15 @@
 # This server maintains a SINGLE TCP connection to SimulStreaming server
 # All WebSocket clients share the same TCP connection.
 # Each client gets its own ffmpeg process for audio decoding.
+# The TCP connection uses the framed protocol of whisper_streaming/frame_protocol.py: the audio goes in AUDIO
+# frames, a new meeting resets the stream by a CONTROL frame, and every RESULT frame is one message to the clients.
 
 import asyncio
 import websockets
 import json
 from aiohttp import web
 from save_meeting_document import save_meeting_documents
+from whisper_streaming import frame_protocol
 
 SIMUL_HOST = '127.0.0.1'
 SIMUL_PORT = 43001
@@ -59,13 +62,16 @@ async def connect_to_simulstreaming():
     for attempt in range(MAX_RETRY):
         try:
             tcp_reader, tcp_writer = await asyncio.open_connection(SIMUL_HOST, SIMUL_PORT)
+            tcp_writer.write(frame_protocol.MAGIC)
+            frame_type, hello = await asyncio.wait_for(read_frame(tcp_reader), timeout=RETRY_DELAY * 5)
+            print(f"[INFO] SimulStreaming protocol: {hello}")
             tcp_connected = True
             print(f"[OK] Connected to SimulStreaming server at {SIMUL_HOST}:{SIMUL_PORT}")
             
             # Khởi động task đọc kết quả từ TCP
             read_task = asyncio.create_task(read_tcp_results())
             return True
-        except ConnectionRefusedError:
+        except (ConnectionRefusedError, asyncio.IncompleteReadError, asyncio.TimeoutError):
             print(f"[WARNING] SimulStreaming server not available, retrying ({attempt + 1}/{MAX_RETRY})...")
             await asyncio.sleep(RETRY_DELAY)
     
@@ -74,6 +80,21 @@ async def connect_to_simulstreaming():
     return False
 
 
+async def read_frame(reader):
+    """Đọc một frame từ TCP: (frame type, JSON message)"""
+    header = await reader.readexactly(frame_protocol.HEADER.size)
+    frame_type, length = frame_protocol.HEADER.unpack(header)
+    payload = await reader.readexactly(length)
+    return frame_type, frame_protocol.decode_json(payload)
+
+
+async def send_control(message):
+    """Gửi CONTROL frame (reset, finish) tới SimulStreaming server"""
+    if tcp_writer and not tcp_writer.is_closing():
+        tcp_writer.write(frame_protocol.encode_json(frame_protocol.CONTROL, message))
+        await tcp_writer.drain()
+
+
 async def reconnect_tcp():
     """Đóng và mở lại TCP connection để reset buffer tại SimulStreaming server"""
     global broadcast_enabled
@@ -116,12 +137,16 @@ async def read_tcp_results():
     
     while tcp_connected and tcp_reader:
         try:
-            data = await asyncio.wait_for(tcp_reader.read(4096), timeout=0.1)
-            if data and broadcast_enabled:
-                text = data.decode(errors='ignore')
-                await broadcast(text)
-        except asyncio.TimeoutError:
-            continue
+            frame_type, message = await read_frame(tcp_reader)
+            if frame_type == frame_protocol.RESULT:
+                if message["text"] and broadcast_enabled:
+                    await broadcast(message["text"])
+            elif message.get("type") == "error":
+                print(f"[ERROR] SimulStreaming server: {message['message']}")
+        except asyncio.IncompleteReadError:
+            print(f"[ERROR] SimulStreaming server closed the connection")
+            tcp_connected = False
+            break
         except Exception as e:
             print(f"[ERROR] read_tcp_results: {e}")
             break
@@ -180,11 +205,14 @@ async def handler(websocket):
         
         # Task forward PCM từ ffmpeg tới TCP
         async def forward_pcm():
+            odd = b""  # AUDIO frames contain whole samples, an odd byte waits for the next read
             while ffmpeg_proc and not ffmpeg_proc.stdout.at_eof():
                 try:
-                    pcm = await ffmpeg_proc.stdout.read(4096)
+                    pcm = odd + await ffmpeg_proc.stdout.read(4096)
+                    odd = pcm[len(pcm) // 2 * 2:]
+                    pcm = pcm[:len(pcm) - len(odd)]
                     if pcm and tcp_writer and not tcp_writer.is_closing():
-                        tcp_writer.write(pcm)
+                        tcp_writer.write(frame_protocol.encode_frame(frame_protocol.AUDIO, pcm))
                         await tcp_writer.drain()
                 except Exception as e:
                     print(f"[ERROR] forward_pcm: {e}")
@@ -197,11 +225,15 @@ async def handler(websocket):
             # Xử lý text message (commands)
             if isinstance(message, str):
                 if message == "NEW_MEETING":
-                    # Cuộc họp mới - reconnect TCP để reset buffer hoàn toàn tại SimulStreaming server
+                    # Cuộc họp mới - reset stream tại SimulStreaming server, không cần reconnect TCP
                     await cleanup_ffmpeg()
                     
-                    # Reconnect TCP - tạo online processor mới tại SimulStreaming server
-                    if await reconnect_tcp():
+                    if tcp_connected:
+                        await send_control({"type": "reset"})
+                        await start_ffmpeg()
+                        print(f"[INFO] New meeting started - stream reset, buffer fully cleared")
+                    # TCP bị ngắt - reconnect, tạo online processor mới tại SimulStreaming server
+                    elif await reconnect_tcp():
                         await start_ffmpeg()
                         print(f"[INFO] New meeting started - TCP reconnected, buffer fully cleared")
                     else:
@@ -209,8 +241,9 @@ async def handler(websocket):
                         print(f"[ERROR] Failed to reconnect TCP for new meeting")
                     
                 elif message == "END_MEETING":
-                    # Kết thúc cuộc họp - cleanup ffmpeg, giữ TCP connection
+                    # Kết thúc cuộc họp - cleanup ffmpeg, xử lý audio còn lại, giữ TCP connection
                     await cleanup_ffmpeg()
+                    await send_control({"type": "finish"})
                     print(f"[INFO] Meeting ended")
                     
                 elif message == "MIC_ON":
@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+PCM_SCALE = np.float32(1 / 32768)  # the same scaling as soundfile's PCM_16 to float32
+
+
+class AudioRing:
+    '''A ring buffer of float32 audio from one producer thread to one consumer thread, with the events in order.
+
+    The producer converts s16 PCM into the preallocated buffer with write() and publishes the written samples with
+    an audio event, or publishes another event, e.g. a control message. The consumer gets the published events
+    with views of their audio, and releases the views when it does not need them, so the producer can overwrite
+    them. The samples of one audio event never wrap around, so every view is contiguous and nothing is copied.
+
+    The positions are counted in the samples since the start. Each of them is changed by one thread only, and the
+    condition is used only to sleep when the ring is full or empty.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.empty(capacity, dtype=np.float32)
+        self.written = 0  # changed by the producer
+        self.read = 0  # the end of the audio given to the consumer, changed by the consumer
+        self.released = 0  # changed by the consumer
+        self.events = deque()  # (kind, end position, payload)
+        self.published_audio = 0  # the end of the last published audio event
+        self.wake = False  # an event that the consumer should not wait with is published
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, pcm):
+        '''Producer: converts the s16 PCM to the ring, as much as fits before the end of the buffer memory. Blocks
+        while the ring is full. Returns the view of the written samples, or None if the ring is closed.'''
+        with self.cond:
+            while self.written - self.released == self.capacity and not self.closed:
+                self.cond.wait()
+        if self.closed:
+            return None
+        start = self.written % self.capacity
+        k = min(len(pcm), self.capacity - (self.written - self.released), self.capacity - start)
+        view = self.buffer[start:start + k]
+        np.multiply(pcm[:k], PCM_SCALE, out=view)
+        self.written += k
+        return view
+
+    def publish(self, kind, payload=None, wake=False):
+        '''Producer: publishes an event. The audio events contain the samples written since the previous one.
+        wake: the consumer gets the events without waiting for min_samples. It is implied for the non-audio events.'''
+        with self.cond:
+            self.events.append((kind, self.written, payload))
+            if kind == "audio":
+                self.published_audio = self.written
+            if wake or kind != "audio":
+                self.wake = True
+            self.cond.notify_all()
+
+    def close(self):
+        '''Ends the stream. The producer stops writing, and the consumer gets the events that are published.'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def pending(self):
+        '''The number of published samples that are not given to the consumer yet.'''
+        return self.published_audio - self.read
+
+    def get(self, min_samples):
+        '''Consumer: blocks until min_samples are published, or a waking event, or the ring is closed. Returns the
+        list of the published events as (kind, audio view or None, payload), or None if the ring is closed and
+        there is no event.'''
+        with self.cond:
+            while not self.closed and self.pending() < min_samples and not self.wake:
+                self.cond.wait()
+            if not self.events:
+                return None
+            events, self.events = list(self.events), deque()
+            self.wake = False
+        result = []
+        for kind, end, payload in events:
+            if kind == "audio":
+                start = self.read % self.capacity
+                result.append((kind, self.buffer[start:start + end - self.read], payload))
+                self.read = end
+            else:
+                result.append((kind, None, payload))
+        return result
+
+    def release(self):
+        '''Consumer: releases the audio views that were given by get().'''
+        with self.cond:
+            self.released = self.read
+            self.cond.notify_all()
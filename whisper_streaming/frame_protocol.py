@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Length-prefixed framing of the streaming server protocol.
+
+A client selects the framed protocol by sending MAGIC as the first bytes of the connection. Otherwise the
+connection is in the raw mode: raw s16le PCM in, and one line of text out per result (see line_packet).
+
+In the framed protocol, every message in both directions is a frame:
+
+  - 1 byte: the frame type
+  - 4 bytes: the payload length, big-endian unsigned
+  - the payload
+
+Frame types:
+
+  AUDIO (client -> server): 16 kHz mono s16le PCM, an even number of bytes.
+
+  CONTROL (both directions): a UTF-8 JSON object with "type":
+    - client: "reset" (a new stream, the pending audio and the context are dropped), "finish" (the pending audio
+      is processed as the end of the stream, the server answers with a result with "finished": true),
+      "config" (the other keys are option names and values, only "min_chunk_size" is supported)
+    - server: "hello" (the first frame, with "version"), "ack" (with "request": the control type), "error" (with
+      "message")
+
+  RESULT (server -> client): a UTF-8 JSON object with "start", "end" (seconds), "text", "tokens", "words": the
+  list of {"start", "end", "text"}, and "lag": the seconds from the arrival of the last processed audio to the
+  result, plus the seconds of the received audio that is not processed yet.
+"""
+
+import json
+import struct
+
+VERSION = 1
+MAGIC = b"SWS" + bytes([VERSION])
+
+AUDIO = 1
+CONTROL = 2
+RESULT = 3
+
+HEADER = struct.Struct("!BI")
+MAX_PAYLOAD = 1 << 20  # larger frames are a protocol error
+RECEIVE_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload):
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_json(frame_type, message):
+    return encode_frame(frame_type, json.dumps(message, ensure_ascii=False).encode("utf-8"))
+
+
+def decode_json(payload):
+    try:
+        message = json.loads(bytes(payload).decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(f"invalid JSON payload: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("the JSON payload is not an object")
+    return message
+
+
+def result_message(iteration_output, finished=False, lag=None):
+    '''Converts the output of the online processor's process_iter() or finish() to a RESULT message.'''
+    o = iteration_output or {}
+    message = {
+        "start": round(o["start"], 3) if "start" in o else None,
+        "end": round(o["end"], 3) if "end" in o else None,
+        "text": o.get("text", ""),
+        "tokens": [int(t) for t in o.get("tokens", [])],
+        "words": [{"start": round(w["start"], 3), "end": round(w["end"], 3), "text": w["text"]}
+                  for w in o.get("words", [])],
+    }
+    if lag is not None:
+        message["lag"] = round(lag, 3)
+    if finished:
+        message["finished"] = True
+    return message
+
+
+class FrameReader:
+    """Receives frames from a blocking socket, with one reusable receive buffer."""
+
+    def __init__(self, socket, initial=b""):
+        self.socket = socket
+        self.buffer = memoryview(bytearray(RECEIVE_SIZE))
+        self.data = bytearray(initial)  # received bytes that are not returned yet
+
+    def receive_frame(self):
+        '''Blocks until a whole frame is received. Returns (frame type, payload bytes), or None if the connection
+        is closed.'''
+        while True:
+            if len(self.data) >= HEADER.size:
+                frame_type, length = HEADER.unpack_from(self.data)
+                if length > MAX_PAYLOAD:
+                    raise ProtocolError(f"frame of {length} bytes is too long")
+                end = HEADER.size + length
+                if len(self.data) >= end:
+                    payload = bytes(self.data[HEADER.size:end])
+                    del self.data[:end]
+                    return frame_type, payload
+            n = self.socket.recv_into(self.buffer)
+            if n == 0:
+                return None
+            self.data += self.buffer[:n]
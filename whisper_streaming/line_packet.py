@@ -12,6 +12,8 @@ containing:
 Originally from the UEDIN team of the ELITR project. 
 """
 
+import re
+
 PACKET_SIZE = 65536
 
 
@@ -64,12 +66,12 @@ def receive_one_line(socket):
         A string representing a single line with a terminating newline or
         None if the connection has been closed.
     """
-    data = b''
+    data = bytearray()
     while True:
         packet = socket.recv(PACKET_SIZE)
         if not packet:  # Connection has been closed.
             return None
-        data += packet
+        data += packet  # in place, linear in the total length
         if b'\0' in packet:
             break
     # TODO Is there a better way of handling bad input than 'replace'?
@@ -91,3 +93,59 @@ def receive_lines(socket):
     if len(lines)==1 and not lines[0]:
         return None
     return lines
+
+
+_TERMINATOR = re.compile(b'[\n\0]')
+
+
+class LineReader:
+    """Receives lines of text from a socket with incremental framing.
+
+    The bytes are received into one reusable buffer. A line is terminated by \n or \0, and the \0 padding is
+    skipped. An incomplete line is kept until its end arrives in a later receive, so the lines are not split or
+    joined at the packet boundaries. A line longer than max_line_length bytes is split, to bound the memory.
+    """
+
+    def __init__(self, socket, buffer_size=PACKET_SIZE, max_line_length=PACKET_SIZE):
+        self.socket = socket
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.max_line_length = max_line_length
+        self.partial = bytearray()  # the received bytes that are not returned yet
+        self.lines = []  # the complete lines that are not returned yet
+
+    def _receive(self):
+        """Receives the available bytes into self.lines. Returns False if the connection is closed."""
+        n = self.socket.recv_into(self.buffer)
+        if n == 0:
+            return False
+        scanned = len(self.partial)  # the bytes before were already searched for the terminators
+        self.partial += self.buffer[:n]
+        start = 0
+        for m in _TERMINATOR.finditer(self.partial, scanned):
+            if m.start() > start:
+                self.lines.append(self.partial[start:m.start()].decode('utf-8', errors='replace'))
+            start = m.end()
+        if len(self.partial) - start > self.max_line_length:
+            self.lines.append(self.partial[start:].decode('utf-8', errors='replace'))
+            start = len(self.partial)
+        del self.partial[:start]
+        return True
+
+    def receive_lines(self):
+        """Receives the available bytes, blocking until some arrive if the socket is blocking. Returns the list of
+        the complete lines, which is empty if no line is complete yet, or None if the connection is closed."""
+        try:
+            if not self._receive():
+                return None
+        except BlockingIOError:
+            pass
+        lines, self.lines = self.lines, []
+        return lines
+
+    def receive_one_line(self):
+        """Blocks until a complete line is received, and returns it with a terminating newline, or None if the
+        connection is closed. The other received lines are kept for the next calls."""
+        while not self.lines:
+            if not self._receive():
+                return None
+        return self.lines.pop(0) + '\n'
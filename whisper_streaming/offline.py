@@ -0,0 +1,88 @@
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from whisper_streaming.silero_vad_iterator import VADIterator
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+VAD_WINDOW = 512  # the window size that Silero VAD requires
+
+
+def speech_segments(audio, vad_model, min_gap=0.5):
+    '''Splits the audio to the voiced segments by Silero VAD.
+    min_gap: the voiced segments separated by a shorter silence, in seconds, are merged.
+    Returns the list of (beg, end) in samples.'''
+    vad = VADIterator(vad_model)
+    segments = []
+    beg = None
+    x = torch.from_numpy(audio)
+    for i in range(0, len(audio) - VAD_WINDOW + 1, VAD_WINDOW):
+        r = vad(x[i:i + VAD_WINDOW])
+        if r is None:
+            continue
+        if "start" in r:
+            beg = r["start"]
+        elif "end" in r and beg is not None:
+            segments.append((beg, min(r["end"], len(audio))))
+            beg = None
+    if beg is not None:
+        segments.append((beg, len(audio)))
+
+    merged = []
+    for b, e in segments:
+        if merged and b - merged[-1][1] < min_gap * SAMPLING_RATE:
+            merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((b, e))
+    return merged
+
+
+def transcribe_segment(online, audio, beg, end, chunk_size):
+    '''Processes one segment as a stream of chunk_size seconds in the computationally unaware way.
+    Returns the list of the non-empty iteration outputs, with the timestamps in the whole audio.'''
+    online.init(offset=beg / SAMPLING_RATE)
+    step = int(chunk_size * SAMPLING_RATE)
+    outputs = []
+    for b in range(beg, end, step):
+        online.insert_audio_chunk(audio[b:min(b + step, end)])
+        try:
+            o = online.process_iter()
+        except AssertionError as e:
+            logger.error(f"assertion error: {repr(e)}")
+            continue
+        if o:
+            outputs.append(o)
+    o = online.finish()
+    if o:
+        outputs.append(o)
+    return outputs
+
+
+def transcribe_offline(audio, segments, online_factory, chunk_size, workers=1):
+    '''Transcribes the segments of a finished recording concurrently.
+
+    Every worker thread processes the segments by its own online processor from online_factory(). The processors
+    can share one model, and the model serializes or batches their inference (--encoder_batch_size and
+    --decode_batch_size in SimulStreaming). Every segment starts with an empty context.
+
+    Yields the outputs of the segments in the order of the segments, as soon as they are ready.
+    '''
+    processors = queue.Queue()
+    for _ in range(min(workers, max(len(segments), 1))):
+        processors.put(online_factory())
+
+    def run(segment):
+        online = processors.get()
+        try:
+            return transcribe_segment(online, audio, *segment, chunk_size)
+        finally:
+            processors.put(online)
+
+    with ThreadPoolExecutor(max_workers=processors.qsize()) as pool:
+        for (beg, end), outputs in zip(segments, pool.map(run, segments)):
+            logger.info(f"## segment {beg / SAMPLING_RATE:.2f}-{end / SAMPLING_RATE:.2f} s: {len(outputs)} outputs")
+            yield from outputs
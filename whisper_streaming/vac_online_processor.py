@@ -2,10 +2,20 @@ from whisper_streaming.base import OnlineProcessorInterface
 from whisper_streaming.silero_vad_iterator import FixedVADIterator
 import numpy as np
 
+import copy
 import logging
 logger = logging.getLogger(__name__)
 import sys
 
+def load_vad_model():
+    '''Loads Silero VAD. It can be loaded once and passed to many VACOnlineASRProcessor objects.'''
+    import torch
+    model, _ = torch.hub.load(
+        repo_or_dir='snakers4/silero-vad',
+        model='silero_vad'
+    )
+    return model
+
 class VACOnlineASRProcessor(OnlineProcessorInterface):
     '''Wraps OnlineASRProcessor with VAC (Voice Activity Controller).
 
@@ -14,18 +24,18 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
     When it detects end of speech (non-voice for 500ms), it makes OnlineASRProcessor to end the utterance immediately.
     '''
 
-    def __init__(self, online_chunk_size, online, min_buffered_length=1):
+    def __init__(self, online_chunk_size, online, min_buffered_length=1, vad_model=None):
         self.online_chunk_size = online_chunk_size
         self.online = online
 
         self.min_buffered_frames = int(min_buffered_length * self.SAMPLING_RATE)
 
         # VAC:
-        import torch
-        model, _ = torch.hub.load(
-            repo_or_dir='snakers4/silero-vad',
-            model='silero_vad'
-        )
+        if vad_model is None:
+            model = load_vad_model()
+        else:
+            # the model keeps the state of the stream, so every processor needs its own copy
+            model = copy.deepcopy(vad_model)
         self.vac = FixedVADIterator(model)  # we use the default options there: 500ms silence, 100ms padding, etc.
 
         self.init()
@@ -45,7 +55,15 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
         self.audio_buffer = np.array([],dtype=np.float32)
 
     def insert_audio_chunk(self, audio):
-        res = self.vac(audio)
+        self.insert_voice(audio, self.detect_voice(audio))
+
+    def detect_voice(self, audio):
+        '''Runs VAD on the audio chunk. It can run ahead of insert_voice, e.g. in another thread, if the chunks come
+        to both in the same order.'''
+        return self.vac(audio)
+
+    def insert_voice(self, audio, res):
+        '''Inserts the audio chunk with its VAD result from detect_voice.'''
         self.audio_buffer = np.append(self.audio_buffer, audio)
         if res is not None:
             frame = list(res.values())[0] - self.buffer_offset
@@ -7,7 +7,6 @@
 
 import sys
 import numpy as np
-import librosa
 from functools import lru_cache
 import time
 import logging
@@ -17,6 +16,7 @@ logger = logging.getLogger(__name__)
 
 @lru_cache(10**6)
 def load_audio(fname):
+    import librosa  # imported here because it is slow to import and the server does not need it
     a, _ = librosa.load(fname, sr=16000, dtype=np.float32)
     return a
 
@@ -53,7 +53,16 @@ def processor_args(parser):
     parser.add_argument("--logdir", help="Directory to save audio segments and generated texts for debugging.",
                        default=None)
 
-def asr_factory(args, factory=None):
+def wrap_vac(args, online, vad_model=None):
+    """Wraps the online processor with VAC if it is enabled in args.
+    vad_model: Silero VAD model loaded by load_vad_model(), to avoid loading it again. None: it is loaded.
+    """
+    if args.vac:
+        from whisper_streaming.vac_online_processor import VACOnlineASRProcessor
+        online = VACOnlineASRProcessor(args.min_chunk_size, online, vad_model=vad_model)
+    return online
+
+def asr_factory(args, factory=None, vad_model=None):
     """
     Creates and configures an asr and online processor object through factory that is implemented in the backend.
     """
@@ -64,9 +73,7 @@ def asr_factory(args, factory=None):
     asr, online = factory(args)
 
     # Create the OnlineASRProcessor
-    if args.vac:
-        from whisper_streaming.vac_online_processor import VACOnlineASRProcessor
-        online = VACOnlineASRProcessor(args.min_chunk_size, online)
+    online = wrap_vac(args, online, vad_model)
 
     if args.task == "translate":
         if args.model_path.endswith(".en.pt"):
@@ -76,6 +83,13 @@ def asr_factory(args, factory=None):
 
     return asr, online
 
+def online_factory(args, asr, factory, vad_model=None):
+    """
+    Creates a new online processor for an already loaded asr object, e.g. for a new client of the server.
+    factory: function that creates the backend's online processor from the asr object.
+    """
+    return wrap_vac(args, factory(asr), vad_model)
+
 def set_logging(args,logger):
     logging.basicConfig(
         # this format would include module name:
@@ -90,15 +104,22 @@ def simulation_args(parser):
     simulation_group = parser.add_argument_group("Arguments for simulation from file")
     simulation_group.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav, on which live streaming is simulated.")
     simulation_group.add_argument('--start_at', type=float, default=0.0, help='Start processing audio at this time.')
-    # TODO: offline mode is not implemented in SimulStreaming yet
-#    simulation_group.add_argument('--offline', action="store_true", default=False, help='Offline mode.')
+    simulation_group.add_argument('--offline', action="store_true", default=False,
+                                  help='Offline mode: the audio is split by VAD and the segments are processed concurrently, '
+                                  'as fast as possible. The outputs are printed in the order of the segments.')
+    simulation_group.add_argument('--offline_workers', type=int, default=4,
+                                  help='The number of segments processed concurrently in the offline mode. The workers share one '
+                                  'model, whose inference is serialized unless it is batched, so the encoder and decode batch sizes '
+                                  'of 1 are raised to this number.')
     simulation_group.add_argument('--comp_unaware', action="store_true", default=False, help='Computationally unaware simulation.')
 
-def main_simulation_from_file(factory, add_args=None):
+def main_simulation_from_file(factory, add_args=None, stream_factory=None):
     '''
     factory: function that creates the ASR and online processor object from args and logger.  
             or in the default WhisperStreaming local agreement backends (not implemented but could be).
     add_args: add specific args for the backend
+    stream_factory: function that creates a new online processor for the loaded ASR object. If it is set, the
+            segments of the offline mode share one model. Otherwise, the ASR object is created for every worker.
     '''
 
     import argparse
@@ -111,7 +132,6 @@ def main_simulation_from_file(factory, add_args=None):
     simulation_args(parser)
 
     args = parser.parse_args()
-    args.offline = False  # TODO: offline mode is not implemented in SimulStreaming yet
 
     if args.offline and args.comp_unaware:
         logger.error("No or one option from --offline and --comp_unaware are available, not both. Exiting.")
@@ -119,6 +139,13 @@ def main_simulation_from_file(factory, add_args=None):
 
     set_logging(args,logger)
 
+    if args.offline and stream_factory is not None:
+        # the segments share one model, and they are processed concurrently only in its batches
+        for name in ("encoder_batch_size", "decode_batch_size"):
+            if getattr(args, name, None) == 1 and args.offline_workers > 1:
+                logger.info(f"--{name} set to --offline_workers {args.offline_workers}")
+                setattr(args, name, args.offline_workers)
+
     audio_path = args.audio_path
 
     SAMPLING_RATE = 16000
@@ -159,16 +186,22 @@ def main_simulation_from_file(factory, add_args=None):
         else:
             logger.debug("No text in this segment")
 
-    if args.offline: ## offline mode processing (for testing/debugging)
-        a = load_audio(audio_path)
-        online.insert_audio_chunk(a)
-        try:
-            o = online.process_iter()
-        except AssertionError as e:
-            logger.error(f"assertion error: {repr(e)}")
+    if args.offline:
+        from whisper_streaming.offline import speech_segments, transcribe_offline
+        from whisper_streaming.vac_online_processor import load_vad_model
+        audio = load_audio(audio_path)
+        offset = int(beg*SAMPLING_RATE)
+        segments = [(b + offset, e + offset) for b, e in speech_segments(audio[offset:], load_vad_model())]
+        logger.info(f"{len(segments)} speech segments, {sum(e - b for b, e in segments)/SAMPLING_RATE:.2f} seconds")
+        if stream_factory is not None:
+            new_online = lambda: stream_factory(asr)
         else:
+            new_online = lambda: asr_factory(args, factory)[1]
+        start = time.time()
+        for o in transcribe_offline(audio, segments, new_online, args.min_chunk_size, args.offline_workers):
             output_transcript(o)
-        now = None
+        logger.info(f"Processed {duration:.2f} seconds of audio in {time.time() - start:.2f} seconds.")
+        return
     elif args.comp_unaware:  # computational unaware mode 
         end = beg + min_chunk
         while True:
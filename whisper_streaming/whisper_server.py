@@ -15,17 +15,25 @@ SAMPLING_RATE = 16000
 ######### Server objects
 
 import whisper_streaming.line_packet as line_packet
+import whisper_streaming.frame_protocol as frame_protocol
+from whisper_streaming.audio_ring import AudioRing
 import socket
+import threading
+import time
 
 class Connection:
     '''it wraps conn object'''
-    PACKET_SIZE = 32000*5*60 # 5 minutes # was: 65536
+    PACKET_SIZE = 65536  # bytes received at once at most
 
     def __init__(self, conn):
         self.conn = conn
         self.last_line = ""
 
         self.conn.setblocking(True)
+        # reusable receive buffers, so the memory per connection is constant
+        self.buffer = memoryview(bytearray(self.PACKET_SIZE))
+        self.line_reader = line_packet.LineReader(conn)
+        self.unread = b""  # the bytes that were read by detect_protocol and are raw audio
 
     def send(self, line):
         '''it doesn't send the same line twice, because it was problematic in online-text-flow-events'''
@@ -35,52 +43,187 @@ class Connection:
         self.last_line = line
 
     def receive_lines(self):
-        in_line = line_packet.receive_lines(self.conn)
+        in_line = self.line_reader.receive_lines()
         return in_line
 
     def non_blocking_receive_audio(self):
         try:
-            r = self.conn.recv(self.PACKET_SIZE)
-            return r
+            n = self.conn.recv_into(self.buffer)
+            return bytes(self.buffer[:n])
         except ConnectionResetError:
             return None
 
-import io
-import soundfile
+    def receive_audio_into(self, buffer):
+        '''Receives the available bytes into the buffer (a writable memoryview), blocking until some are available.
+        Returns the number of received bytes, 0 if the connection is closed.'''
+        if self.unread:
+            n = min(len(buffer), len(self.unread))
+            buffer[:n] = self.unread[:n]
+            self.unread = self.unread[n:]
+            return n
+        try:
+            return self.conn.recv_into(buffer)
+        except ConnectionResetError:
+            return 0
+
+    def detect_protocol(self):
+        '''Reads the first bytes of the connection. Returns True if the client selects the framed protocol by
+        frame_protocol.MAGIC. Otherwise the bytes are raw audio and they are kept for receive_audio_into.'''
+        head = b""
+        try:
+            while len(head) < len(frame_protocol.MAGIC):
+                r = self.conn.recv(len(frame_protocol.MAGIC) - len(head))
+                if not r:
+                    break
+                head += r
+        except ConnectionResetError:
+            pass
+        if head == frame_protocol.MAGIC:
+            return True
+        self.unread = head
+        return False
+
+    def send_frame(self, data):
+        self.conn.sendall(data)
 
 # wraps socket and ASR object, and serves one client connection. 
 # next client should be served by a new instance of this object
 class ServerProcessor:
+    '''The session is pipelined: a producer thread receives the audio, converts it and runs VAD into a ring buffer,
+    while the inference loop processes whatever is ready. So the network and VAD work overlaps with the model.
+
+    The lag is the time from the arrival of the last processed audio to its result, plus the duration of the received
+    audio that is not processed yet. So the audio that waits in the ring counts, and a full ring, when the rest waits
+    in the socket, means at least MAX_CHUNK of lag. The inference loop waits for more audio when the iterations get
+    slower, so it keeps up with real time by fewer, larger iterations. When the lag exceeds max_lag, the partial
+    updates are skipped: it waits for MAX_ITERATION_CHUNK of audio or for the end of an utterance, until the lag
+    drops below the half.'''
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    MAX_CHUNK = 10  # seconds of audio that are buffered at most. The rest waits in the socket.
+    COALESCE = 1.5  # the audio of an iteration is at least this multiple of the iteration time
+    MAX_ITERATION_CHUNK = 5  # seconds of audio of an iteration at most, when coalescing or skipping the partial updates
+
+    def __init__(self, c, online_asr_proc, min_chunk, max_lag=None):
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
+        self.max_lag = max_lag
 
-        self.is_first = True
-
-    def receive_audio_chunk(self):
-        # receive all audio that is available by this time
-        # blocks operation if less than self.min_chunk seconds is available
-        # unblocks if connection is closed or a chunk is available
-        out = []
-        minlimit = self.min_chunk*SAMPLING_RATE
-        while sum(len(x) for x in out) < minlimit:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            if not raw_bytes:
-                break
-#            print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
-            out.append(audio)
-        if not out:
-            return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
+        self.lag = 0.0
+        self.iteration_time = 0.0  # moving average of the process_iter time
+        self.shedding = False
+        self.last_arrival = None  # time.time() of the arrival of the last inserted audio
+
+        # s16le PCM is received into this buffer and converted into the ring, without allocating per packet
+        self.max_samples = int(max(self.MAX_CHUNK, min_chunk) * SAMPLING_RATE)
+        self.raw = bytearray(c.PACKET_SIZE)
+        self.odd_byte = None  # the last received byte if it is the first half of a sample
+        self.ring = AudioRing(self.max_samples)
+
+        # VAC runs VAD in the producer thread
+        self.detect_voice = getattr(online_asr_proc, "detect_voice", None)
+
+    def receive_pcm(self):
+        '''Receives the available audio, blocking until some arrives. Returns the int16 view of the receive buffer,
+        or None if the connection is closed. The view is valid until the next call.'''
+        raw = memoryview(self.raw)
+        carried = 0
+        if self.odd_byte is not None:
+            # written here, not when it was received, because raw[0] was a part of the returned view
+            self.raw[0] = self.odd_byte
+            carried = 1
+        size = self.connection.receive_audio_into(raw[carried:])
+        if not size:
             return None
-        self.is_first = False
-        return np.concatenate(out)
-        
+        size += carried
+        self.odd_byte = self.raw[size - 1] if size % 2 else None
+        return np.frombuffer(self.raw, dtype="<i2", count=size // 2)
+
+    def write_audio(self, pcm):
+        '''Producer: writes the PCM to the ring with the VAD results. Returns False if the ring is closed.'''
+        arrival = time.time()  # before the ring.write() that blocks while the ring is full
+        while len(pcm):
+            audio = self.ring.write(pcm)
+            if audio is None:
+                return False
+            pcm = pcm[len(audio):]
+            vad_result = self.detect_voice(audio) if self.detect_voice is not None else None
+            # the end of an utterance is processed without waiting for more audio
+            self.ring.publish("audio", (vad_result, arrival), wake=vad_result is not None and "end" in vad_result)
+        return True
+
+    def produce(self):
+        # the producer thread
+        try:
+            while True:
+                pcm = self.receive_pcm()
+                if pcm is None or not self.write_audio(pcm):
+                    break
+        except OSError:
+            pass  # the connection was closed by the inference loop
+        finally:
+            self.ring.close()
+
+    def insert_audio(self, audio, payload):
+        vad_result, self.last_arrival = payload
+        if self.detect_voice is not None:
+            self.online_asr_proc.insert_voice(audio, vad_result)
+        else:
+            self.online_asr_proc.insert_audio_chunk(audio)
+
+    def chunk_samples(self):
+        '''The audio to wait for before the next iteration.'''
+        if self.shedding:
+            seconds = self.MAX_ITERATION_CHUNK
+        else:
+            seconds = min(self.COALESCE * self.iteration_time, self.MAX_ITERATION_CHUNK)
+        return int(max(self.min_chunk, seconds) * SAMPLING_RATE)
+
+    def measure(self, t):
+        now = time.time()
+        self.iteration_time += 0.3 * (now - t - self.iteration_time)
+        if self.last_arrival is not None:
+            self.lag = now - self.last_arrival + self.ring.pending() / SAMPLING_RATE
+        if self.max_lag:
+            if not self.shedding and self.lag > self.max_lag:
+                logger.warning(f"lag {self.lag:.2f} s, skipping the partial updates")
+                self.shedding = True
+            elif self.shedding and self.lag < self.max_lag / 2:
+                logger.warning(f"lag {self.lag:.2f} s, the partial updates are resumed")
+                self.shedding = False
+        logger.debug(f"lag {self.lag:.2f} s, iteration {self.iteration_time:.2f} s")
+
+    def process_iter(self):
+        t = time.time()
+        o = self.online_asr_proc.process_iter()
+        self.measure(t)
+        self.send_result(o)
+
+    def handle_event(self, kind, payload):
+        raise ValueError(f"unexpected event {kind}")
+
+    def consumes_audio(self, kind, payload):
+        '''Whether handling the event processes or drops the inserted audio.'''
+        return False
+
+    def process_events(self, events):
+        # The inserted audio is a view of the ring, so it must be processed before the ring is released. It stays
+        # pending over the events that do not consume it.
+        pending = False  # audio is inserted and not processed
+        for kind, audio, payload in events:
+            if kind == "audio":
+                self.insert_audio(audio, payload)
+                pending = True
+                if getattr(self.online_asr_proc, "is_currently_final", False):
+                    # the end of an utterance is processed before the audio of the next one is inserted
+                    self.process_iter()
+                    pending = False
+            else:
+                if self.consumes_audio(kind, payload):
+                    pending = False
+                self.handle_event(kind, payload)
+        if pending:
+            self.process_iter()
 
     def send_result(self, iteration_output):
         # output format in stdout is like:
@@ -96,29 +239,160 @@ class ServerProcessor:
         else:
             logger.debug("No text in this segment")
 
+    def start(self):
+        '''Called in the inference thread before the producer starts.'''
+        self.online_asr_proc.init()
+
     def process(self):
         # handle one client connection
-        self.online_asr_proc.init()
-        while True:
-            a = self.receive_audio_chunk()
-            if a is None:
-                break
-            self.online_asr_proc.insert_audio_chunk(a)
-            o = self.online_asr_proc.process_iter()
-            try:
-                self.send_result(o)
-            except (BrokenPipeError, ConnectionResetError):
-                logger.info("connection closed by client")
-                break
+        try:
+            self.start()
+            threading.Thread(target=self.produce, daemon=True, name="ServerProcessor producer").start()
+            while True:
+                events = self.ring.get(self.chunk_samples())
+                if events is None:
+                    break
+                # the online processor consumes the audio views before they are released
+                self.process_events(events)
+                self.ring.release()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("connection closed by client")
+        finally:
+            self.ring.close()
 
 #        o = online.finish()  # this should be working
 #        self.send_result(o)
 
-def main_server(factory, add_args):
+class FramedServerProcessor(ServerProcessor):
+    '''Serves one client connection of the framed protocol (see frame_protocol). The audio comes in AUDIO frames
+    and it is processed when min_chunk seconds are pending. The CONTROL frames reset or finish the stream without
+    reconnecting, and the results are sent as RESULT frames with the word timestamps.'''
+
+    def __init__(self, c, online_asr_proc, min_chunk, max_lag=None):
+        super().__init__(c, online_asr_proc, min_chunk, max_lag)
+        self.reader = frame_protocol.FrameReader(c.conn)
+        self.reset_done = threading.Event()
+
+    def send_message(self, frame_type, message):
+        self.connection.send_frame(frame_protocol.encode_json(frame_type, message))
+
+    def send_result(self, iteration_output, finished=False):
+        if iteration_output or finished:
+            self.send_message(frame_protocol.RESULT, frame_protocol.result_message(iteration_output, finished, self.lag))
+        else:
+            logger.debug("No text in this segment")
+
+    def produce(self):
+        # the producer thread. The messages to the client are sent by the inference loop, as the events.
+        try:
+            while True:
+                try:
+                    frame = self.reader.receive_frame()
+                except frame_protocol.ProtocolError as e:
+                    self.ring.publish("error", str(e))
+                    break  # the framing is lost
+                if frame is None:
+                    break
+                frame_type, payload = frame
+                try:
+                    if frame_type == frame_protocol.AUDIO:
+                        if len(payload) % 2:
+                            raise frame_protocol.ProtocolError("audio frame with an odd number of bytes")
+                        if not self.write_audio(np.frombuffer(payload, dtype="<i2")):
+                            break
+                    elif frame_type == frame_protocol.CONTROL:
+                        message = frame_protocol.decode_json(payload)
+                        self.reset_done.clear()
+                        self.ring.publish("control", message)
+                        if message.get("type") == "reset":
+                            # the reset of VAD in the inference loop must precede the VAD of the next audio
+                            while not self.reset_done.wait(0.1) and not self.ring.closed:
+                                pass
+                    else:
+                        raise frame_protocol.ProtocolError(f"unexpected frame type {frame_type}")
+                except frame_protocol.ProtocolError as e:
+                    self.ring.publish("error", str(e))
+        except OSError:
+            pass  # the connection was closed by the inference loop
+        finally:
+            self.ring.close()
+
+    def consumes_audio(self, kind, payload):
+        return kind == "control" and payload.get("type") in ("reset", "finish")
+
+    def handle_event(self, kind, payload):
+        if kind == "error":
+            self.protocol_error(payload)
+            return
+        try:
+            self.control(payload)
+        except frame_protocol.ProtocolError as e:
+            self.protocol_error(e)
+        finally:
+            self.reset_done.set()
+
+    def control(self, message):
+        request = message.get("type")
+        if request == "reset":
+            # the inserted audio is dropped
+            self.online_asr_proc.init()
+        elif request == "finish":
+            t = time.time()
+            o = self.online_asr_proc.finish()
+            self.measure(t)
+            self.send_result(o, finished=True)
+            return
+        elif request == "config":
+            for key, value in message.items():
+                if key == "type":
+                    continue
+                if key != "min_chunk_size":
+                    raise frame_protocol.ProtocolError(f"unsupported option {key!r}")
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    raise frame_protocol.ProtocolError(f"invalid min_chunk_size {value!r}")
+                if not 0 < value <= self.MAX_CHUNK:
+                    raise frame_protocol.ProtocolError(f"min_chunk_size must be in (0, {self.MAX_CHUNK}]")
+                self.min_chunk = value
+        else:
+            raise frame_protocol.ProtocolError(f"unknown control message {request!r}")
+        self.send_message(frame_protocol.CONTROL, {"type": "ack", "request": request})
+
+    def protocol_error(self, e):
+        logger.warning(f"protocol error: {e}")
+        self.send_message(frame_protocol.CONTROL, {"type": "error", "message": str(e)})
+
+    def start(self):
+        super().start()
+        self.send_message(frame_protocol.CONTROL, {"type": "hello", "version": frame_protocol.VERSION})
+
+def serve_client(conn, addr, online, min_chunk, slots=None, max_lag=None):
+    """Serves one client connection, possibly in a separate thread. It releases a slot of the semaphore at the end.
+    The client selects the framed protocol or the raw audio by its first bytes."""
+    try:
+        connection = Connection(conn)
+        if connection.detect_protocol():
+            proc = FramedServerProcessor(connection, online, min_chunk, max_lag)
+        else:
+            proc = ServerProcessor(connection, online, min_chunk, max_lag)
+        proc.process()
+    except Exception as e:
+        logger.error(f'Error while serving client {addr}: {e}')
+    finally:
+        conn.close()
+        logger.info(f'Connection to client {addr} closed')
+        if slots is not None:
+            slots.release()
+
+def main_server(factory, add_args, stream_factory=None):
     '''
     factory: function that creates the ASR and online processor object from args and logger.  
             or in the default WhisperStreaming local agreement backends (not implemented but could be).
     add_args: add specific args for the backend
+    stream_factory: function that creates a new online processor for the loaded ASR object. If it is set, the model
+            is loaded once and shared by all clients, and up to --max-clients clients are served concurrently.
+            Otherwise, the ASR object is created again for every client, and the clients are served one by one.
     '''
     logger = logging.getLogger(__name__)
     parser = argparse.ArgumentParser()
@@ -129,6 +403,13 @@ def main_server(factory, add_args):
     parser.add_argument("--warmup-file", type=str, dest="warmup_file", 
             help="The path to a speech audio wav file to warm up Whisper so that the very first chunk processing is fast. It can be e.g. "
             "https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav .")
+    parser.add_argument("--max-clients", type=int, default=1, dest="max_clients",
+            help="Max number of clients that are served concurrently with one shared model. The inference of the clients is "
+            "serialized. The other clients wait until a client disconnects.")
+    parser.add_argument("--max-lag", type=float, default=5, dest="max_lag",
+            help="When the result of a client lags more than this number of seconds behind its audio, the partial updates "
+            "are skipped until it catches up. 0 to disable. The lag counts the received audio that is not processed yet. "
+            "It is sent in the RESULT frames of the framed protocol, the raw protocol only logs it.")
 
     # options from whisper_online
     processor_args(parser)
@@ -141,8 +422,12 @@ def main_server(factory, add_args):
 
     # setting whisper object by args 
 
+    vad_model = None
+    if args.vac:
+        from whisper_streaming.vac_online_processor import load_vad_model
+        vad_model = load_vad_model()
 
-    asr, _ = asr_factory(args, factory)
+    asr, _ = asr_factory(args, factory, vad_model)
     if args.vac:
         min_chunk = args.vac_chunk_size
     else:
@@ -163,22 +448,30 @@ def main_server(factory, add_args):
         logger.warning(msg)
 
     # server loop
+    slots = threading.BoundedSemaphore(args.max_clients)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((args.host, args.port))
-        s.listen(1)
+        s.listen(args.max_clients)
         logger.info('Listening on'+str((args.host, args.port)))
         while True:
+            conn = None
             try:
+                slots.acquire()
                 conn, addr = s.accept()
                 logger.info('Connected to client on {}'.format(addr))
-                # Tạo online_asr_proc mới cho mỗi client
-                _, online = asr_factory(args, factory)
-                connection = Connection(conn)
-                proc = ServerProcessor(connection, online, min_chunk)
-                proc.process()
-                conn.close()
-                logger.info('Connection to client closed')
+                if stream_factory is not None:
+                    # a new stream of the shared model
+                    online = online_factory(args, asr, stream_factory, vad_model)
+                    threading.Thread(target=serve_client, args=(conn, addr, online, min_chunk, slots, args.max_lag), daemon=True).start()
+                else:
+                    # Tạo online_asr_proc mới cho mỗi client
+                    _, online = asr_factory(args, factory, vad_model)
+                    serve_client(conn, addr, online, min_chunk, slots, args.max_lag)
             except Exception as e:
                 logger.error(f'Error in main_server loop: {e}')
+                if conn is not None:
+                    # the client was not handed over to serve_client, which closes it otherwise
+                    conn.close()
+                slots.release()
                 continue
-        # Không kết thúc tiến trình, luôn chờ client mới
\ No newline at end of file
+        # Không kết thúc tiến trình, luôn chờ client mới